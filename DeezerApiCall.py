@@ -1,38 +1,114 @@
 import subprocess
 import os
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import time
 import sys
+import functools
 import glob
 import json
+import re
+import shelve
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# پسوند فایل‌های صوتی که deemix تولید می‌کند
+_AUDIO_EXTS = frozenset({'.mp3', '.flac', '.m4a', '.opus'})
+
+# خطی که deemix بعد از ذخیره فایل چاپ می‌کند
+_DEEMIX_PATH_RE = re.compile(
+    r'(?:Downloaded to|Saved to):?\s+(.+\.(?:mp3|flac|m4a|opus))\s*$',
+    re.IGNORECASE | re.MULTILINE
+)
 
 
 class DeemixDownloader:
-    def __init__(self, deemix_path='deemix', arl_token=None):
+    # تنظیمات کیفیت فقط یک بار در هر پروسه اعمال می‌شود
+    _quality_configured = False
+    # فایل‌های کش بین همه نمونه‌های کلاس مشترک‌اند (dbm اجازه دو بار باز کردن نمی‌دهد)
+    # مسیر → [shelf، تعداد نمونه‌های استفاده‌کننده]؛ با آخرین close بسته می‌شود
+    _shelves = {}
+    _cache_lock = threading.Lock()
+
+    def __init__(self, deemix_path='deemix', arl_token=None, max_workers=4):
         """Initialize with the path to the deemix executable and optional ARL token."""
         self.deemix_path = deemix_path
+        self.max_workers = max_workers
+        self._print_lock = threading.Lock()
         self.config_file = os.path.expanduser('~/.config/deemix/.arl')
         self.settings_file = os.path.expanduser('~/.config/deemix/config.json')
+        self.search_cache_file = os.path.expanduser('~/.cache/deemix_search.db')
+        self.path_cache_file = os.path.expanduser('~/.cache/deemix_paths.db')
+        
+        # کش نتایج جستجو: (نام ترک، هنرمند) → لینک دیزر
+        # کش مسیر فایل‌ها: (نام ترک، هنرمند) → آخرین فایل دانلود شده
+        cache_dir = os.path.dirname(self.search_cache_file)
+        os.makedirs(cache_dir, exist_ok=True)
+        self._search_cache = self._open_shelf(self.search_cache_file)
+        self._path_cache = self._open_shelf(self.path_cache_file)
+        self._closed = False
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(
+            pool_connections=16,
+            pool_maxsize=16,
+            max_retries=Retry(total=3, backoff_factor=0.3)
+        ))
         
         if arl_token:
             self.set_arl(arl_token)
         
         self._load_arl()
-        self._configure_quality()
+        if not DeemixDownloader._quality_configured:
+            self._configure_quality()
+            DeemixDownloader._quality_configured = True
+
+    @classmethod
+    def _open_shelf(cls, path):
+        """باز کردن (یا استفاده دوباره از) فایل کش مشترک."""
+        with cls._cache_lock:
+            entry = cls._shelves.get(path)
+            if entry is None:
+                entry = cls._shelves[path] = [shelve.open(path), 0]
+            entry[1] += 1
+            return entry[0]
+
+    @classmethod
+    def _release_shelf(cls, path):
+        """کم کردن شمارنده؛ فایل کش فقط وقتی آخرین نمونه رهایش کند بسته می‌شود."""
+        with cls._cache_lock:
+            entry = cls._shelves.get(path)
+            if entry is None:
+                return
+            entry[1] -= 1
+            if entry[1] <= 0:
+                del cls._shelves[path]
+                entry[0].close()
+
+    @staticmethod
+    @functools.lru_cache(maxsize=1)
+    def _read_arl_file(path):
+        """خواندن ARL از فایل؛ نتیجه تا تغییر توکن کش می‌شود."""
+        try:
+            with open(path, 'r') as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return None
 
     def _load_arl(self):
         """بارگذاری خودکار ARL از فایل."""
-        if os.path.exists(self.config_file):
-            with open(self.config_file, 'r') as f:
-                self.arl_token = f.read().strip()
-            return True
-        return False
+        arl_token = self._read_arl_file(self.config_file)
+        if arl_token is None:
+            return False
+        self.arl_token = arl_token
+        return True
 
     def _configure_quality(self):
         """تنظیم کیفیت پایین‌تر برای حساب‌های رایگان."""
         config_dir = os.path.dirname(self.settings_file)
-        if not os.path.exists(config_dir):
-            os.makedirs(config_dir)
+        os.makedirs(config_dir, exist_ok=True)
         
         # تنظیمات پیش‌فرض برای حساب رایگان
         default_config = {
@@ -104,13 +180,16 @@ class DeemixDownloader:
                     config = json.load(f)
                 
                 # اطمینان از تنظیمات مناسب برای حساب رایگان
-                config['maxBitrate'] = '128'
-                config['fallbackBitrate'] = True
+                new_config = {**config, 'maxBitrate': '128', 'fallbackBitrate': True}
+                
+                # اگر تنظیمات از قبل درست است، فایل را دوباره ننویس
+                if new_config == config:
+                    return
                 
                 with open(self.settings_file, 'w') as f:
-                    json.dump(config, f, indent=2)
+                    json.dump(new_config, f, indent=2)
                 print(f"⚙️  Updated config for free account (128kbps)")
-            except:
+            except (OSError, json.JSONDecodeError):
                 pass
 
     def set_arl(self, arl_token):
@@ -118,11 +197,11 @@ class DeemixDownloader:
         self.arl_token = arl_token
         
         config_dir = os.path.dirname(self.config_file)
-        if not os.path.exists(config_dir):
-            os.makedirs(config_dir)
+        os.makedirs(config_dir, exist_ok=True)
         
         with open(self.config_file, 'w') as f:
             f.write(arl_token)
+        DeemixDownloader._read_arl_file.cache_clear()
         
         print(f"✅ ARL token saved permanently to {self.config_file}")
 
@@ -142,64 +221,55 @@ class DeemixDownloader:
 
             # ایجاد پوشه خروجی با مسیر کامل
             output_dir = os.path.abspath(output_dir)
-            if not os.path.exists(output_dir):
-                os.makedirs(output_dir)
+            os.makedirs(output_dir, exist_ok=True)
 
-            # ذخیره لیست فایل‌های قبل از دانلود
-            before_files = self._get_files_in_dir(output_dir)
+            # زمان شروع دانلود؛ فایل‌های جدیدتر از این زمان خروجی deemix هستند
+            started_at = time.time()
 
-            # اجرای دستور deemix با کیفیت مشخص
-            command = [
-                self.deemix_path, 
-                track_url, 
-                '-p', output_dir,
-                '-b', bitrate  # تنظیم bitrate
-            ]
-            
             print(f"🎵 Quality: {bitrate}kbps (suitable for free accounts)")
             
-            process = subprocess.Popen(
-                command,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                text=True,
-                bufsize=1
-            )
-
-            # نمایش خروجی
-            for line in process.stdout:
-                print(line, end='')
-                sys.stdout.flush()
-
-            return_code = process.wait(timeout=300)
-
-            # پیدا کردن فایل جدید دانلود شده
-            time.sleep(2)
-            after_files = self._get_files_in_dir(output_dir)
-            new_files = after_files - before_files
+            # اجرای دستور deemix با کیفیت مشخص
+            return_code, output = self._run_deemix([track_url], output_dir, bitrate)
+
+            # مسیر فایل از خروجی خود deemix؛ در غیر این صورت فایل جدید پوشه
+            match = _DEEMIX_PATH_RE.search(output)
+            if match and os.path.isfile(match.group(1)):
+                new_files = [match.group(1)]
+            else:
+                new_files = self._get_new_files(output_dir, started_at)
             
             if new_files:
-                downloaded_file = list(new_files)[0]
+                downloaded_file = new_files[0]
                 file_size = os.path.getsize(downloaded_file)
                 print(f"✅ Downloaded: {track_name} by {artist_name}")
                 print(f"📁 File: {downloaded_file}")
                 print(f"📦 Size: {file_size / (1024*1024):.2f} MB\n")
+                self._remember_path(track_name, artist_name, downloaded_file)
                 return downloaded_file
             elif return_code == 0:
                 # فایل ممکنه قبلاً دانلود شده باشه
                 print(f"⚠️  No new file created. Searching for existing file...")
-                existing = self._find_track_file(output_dir, track_name, artist_name)
+                existing = self._cached_path(track_name, artist_name)
+                if existing:
+                    print(f"📁 Found previously downloaded file: {existing}\n")
+                    return existing
+                
+                track_words = self._track_words(track_name)
+                existing = self._find_track_file(output_dir, track_name, artist_name,
+                                                 track_words=track_words)
                 if existing:
                     print(f"📁 Found existing file: {existing}\n")
+                    self._remember_path(track_name, artist_name, existing)
                     return existing
                 else:
                     # چک کردن پوشه Music
                     music_dir = os.path.expanduser("~/Music")
-                    if os.path.exists(music_dir):
-                        existing = self._find_track_file(music_dir, track_name, artist_name)
-                        if existing:
-                            print(f"📁 Found in Music folder: {existing}\n")
-                            return existing
+                    existing = self._find_track_file(music_dir, track_name, artist_name,
+                                                     track_words=track_words)
+                    if existing:
+                        print(f"📁 Found in Music folder: {existing}\n")
+                        self._remember_path(track_name, artist_name, existing)
+                        return existing
                     
                     raise Exception(
                         "Download completed but file not found!\n"
@@ -210,71 +280,183 @@ class DeemixDownloader:
                 raise Exception(f"Download failed with return code: {return_code}")
 
         except subprocess.TimeoutExpired:
-            process.kill()
             raise Exception("Download timeout (>5 minutes)")
         except Exception as e:
             raise Exception(f"Error: {str(e)}")
 
-    def _get_files_in_dir(self, directory):
-        """دریافت لیست فایل‌های صوتی در پوشه."""
-        files = set()
-        if os.path.exists(directory):
-            for root, dirs, filenames in os.walk(directory):
-                for f in filenames:
-                    if f.endswith(('.mp3', '.flac', '.m4a', '.opus')):
-                        files.add(os.path.join(root, f))
-        return files
-
-    def _find_track_file(self, directory, track_name, artist_name, max_age_hours=1):
-        """پیدا کردن فایل ترک در پوشه."""
-        if not os.path.exists(directory):
-            return None
+    @staticmethod
+    def _cache_key(track_name, artist_name):
+        """کلید نرمال‌شده کش‌ها برای یک ترک."""
+        return f"{track_name.lower().strip()}|{artist_name.lower().strip()}"
+
+    def _cached_path(self, track_name, artist_name):
+        """مسیر فایل قبلی این ترک، اگر هنوز روی دیسک باشد."""
+        with self._cache_lock:
+            path = self._path_cache.get(self._cache_key(track_name, artist_name))
+        if path and os.path.isfile(path):
+            return path
+        return None
+
+    def _remember_path(self, track_name, artist_name, path):
+        with self._cache_lock:
+            self._path_cache[self._cache_key(track_name, artist_name)] = path
+
+    def _run_deemix(self, urls, output_dir, bitrate, timeout=300):
+        """اجرای deemix برای یک یا چند لینک؛ خروجی نمایش داده و برگردانده می‌شود."""
+        command = [
+            self.deemix_path,
+            *urls,
+            '-p', output_dir,
+            '-b', bitrate  # تنظیم bitrate
+        ]
         
-        current_time = time.time()
-        max_age_seconds = max_age_hours * 3600
+        process = subprocess.Popen(
+            command,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            bufsize=65536
+        )
+
+        # خروجی مستقیم روی fd نوشته می‌شود، بدون لایه‌های TextIOWrapper
+        sys.stdout.flush()
+        stdout_fd = sys.stdout.fileno()
+        chunks = []
+        try:
+            while True:
+                chunk = process.stdout.read1(65536)
+                if not chunk:
+                    break
+                view = memoryview(chunk)
+                while view:
+                    view = view[os.write(stdout_fd, view):]
+                chunks.append(chunk)
+
+            output = b''.join(chunks).decode('utf-8', errors='replace')
+            return process.wait(timeout=timeout), output
+        except subprocess.TimeoutExpired:
+            process.kill()
+            raise
+
+    def _get_new_files(self, directory, since):
+        """دریافت فایل‌های صوتی که بعد از زمان ``since`` در پوشه نوشته شده‌اند.
+
+        Replaces the old before/after listing diff: one pass over the folder
+        using the mtime of each entry instead of two full walks plus a set
+        difference.
+        """
+        # کمی تلورانس برای فایل‌سیستم‌هایی با دقت زمانی پایین
+        cutoff = since - 1
+        new_files = []
+        stack = [directory]
+        while stack:
+            try:
+                entries = os.scandir(stack.pop())
+            except OSError:
+                continue
+            with entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif os.path.splitext(entry.name)[1] in _AUDIO_EXTS:
+                        if entry.stat().st_mtime >= cutoff:
+                            new_files.append(entry.path)
+        return new_files
+
+    @staticmethod
+    def _track_words(track_name):
+        """دو کلمه اول نام ترک برای تطبیق با نام فایل."""
+        return tuple(track_name.lower().split()[:2])
+
+    def _find_track_file(self, directory, track_name, artist_name, max_age_hours=1,
+                         track_words=None):
+        """پیدا کردن فایل ترک در پوشه."""
+        # مقادیر ثابت یک بار خارج از حلقه محاسبه می‌شوند
+        cutoff = time.time() - max_age_hours * 3600
+        if track_words is None:
+            track_words = self._track_words(track_name)
         
-        # جستجوی فایل‌های اخیر
-        for root, dirs, files in os.walk(directory):
-            for f in files:
-                if f.endswith(('.mp3', '.flac', '.m4a', '.opus')):
-                    full_path = os.path.join(root, f)
-                    file_age = current_time - os.path.getctime(full_path)
-                    
-                    # بررسی سن فایل و نام
-                    if file_age < max_age_seconds:
-                        filename_lower = f.lower()
-                        track_words = track_name.lower().split()[:2]
+        # اول فقط بر اساس نام فیلتر می‌کنیم؛ این کار نیازی به stat ندارد
+        candidates = []
+        stack = [directory]
+        while stack:
+            try:
+                entries = os.scandir(stack.pop())
+            except OSError:
+                continue
+            with entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif os.path.splitext(entry.name)[1] in _AUDIO_EXTS:
+                        filename_lower = entry.name.lower()
                         if any(word in filename_lower for word in track_words):
-                            return full_path
+                            candidates.append(entry)
+        
+        if not candidates:
+            return None
+        
+        # stat فایل‌های باقی‌مانده به صورت موازی؛ اولین فایل اخیر برگردانده می‌شود
+        with ThreadPoolExecutor(max_workers=min(32, len(candidates))) as executor:
+            for entry, ctime in zip(candidates, executor.map(self._entry_ctime, candidates)):
+                if ctime > cutoff:
+                    return entry.path
         
         return None
 
-    def download_tracks(self, tracks, output_dir='./downloads', bitrate='128'):
-        """Download multiple tracks."""
+    @staticmethod
+    def _entry_ctime(entry):
+        try:
+            return entry.stat().st_ctime
+        except OSError:
+            return 0
+
+    def download_tracks(self, tracks, output_dir='./downloads', bitrate='128', max_workers=None,
+                        on_complete=None):
+        """Download multiple tracks in parallel.
+
+        ``on_complete(index, path)`` is called from this thread as soon as
+        ``tracks[index]`` finishes, before the batch is done.
+        """
         if not self.is_configured():
             raise Exception("ARL not configured! Run: downloader.set_arl()")
 
-        downloaded_files = []
-        failed_tracks = []
+        # پوشه خروجی یک بار ساخته می‌شود، نه برای هر ترک
+        output_dir = os.path.abspath(output_dir)
+        os.makedirs(output_dir, exist_ok=True)
+
+        workers = max_workers or self.max_workers
+        results = [None] * len(tracks)
         
-        print(f"📦 Starting batch download of {len(tracks)} tracks...")
+        print(f"📦 Starting batch download of {len(tracks)} tracks ({workers} workers)...")
         print(f"🎵 Quality: {bitrate}kbps\n")
         
-        for i, (track_name, artist_name) in enumerate(tracks, 1):
-            try:
-                print(f"{'='*60}")
-                print(f"[{i}/{len(tracks)}] {track_name} - {artist_name}")
-                print('='*60)
-                
-                file_path = self.download_track(track_name, artist_name, output_dir, bitrate)
-                downloaded_files.append((track_name, artist_name, file_path))
-                
-                if i < len(tracks):
-                    time.sleep(2)
-                    
-            except Exception as e:
-                print(f"❌ Failed: {e}\n")
-                failed_tracks.append((track_name, artist_name, str(e)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(self._download_job, i, len(tracks), track_name,
+                                artist_name, output_dir, bitrate): i
+                for i, (track_name, artist_name) in enumerate(tracks)
+            }
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    results[i] = future.result()
+                except Exception as e:
+                    with self._print_lock:
+                        print(f"❌ Failed: {e}\n")
+                    results[i] = e
+                    continue
+                # اطلاع فوری به فراخواننده تا آپلود بدون انتظار برای کل دسته شروع شود
+                if on_complete:
+                    on_complete(i, results[i])
+
+        # حفظ ترتیب ورودی در خروجی
+        downloaded_files = []
+        failed_tracks = []
+        for (track_name, artist_name), result in zip(tracks, results):
+            if isinstance(result, Exception):
+                failed_tracks.append((track_name, artist_name, str(result)))
+            else:
+                downloaded_files.append((track_name, artist_name, result))
         
         # گزارش نهایی
         print(f"\n{'='*60}")
@@ -297,13 +479,44 @@ class DeemixDownloader:
         
         return downloaded_files
 
+    def _download_job(self, index, total, track_name, artist_name, output_dir, bitrate):
+        """Download one track of a batch into its own staging folder.
+
+        Parallel deemix processes share ``output_dir``, so each job downloads
+        into a private sub-folder to keep the before/after file diff from
+        picking up files written by other jobs, then moves the result up.
+        """
+        with self._print_lock:
+            print(f"{'='*60}")
+            print(f"[{index + 1}/{total}] {track_name} - {artist_name}")
+            print('='*60)
+
+        staging_dir = tempfile.mkdtemp(prefix='.track-', dir=output_dir)
+        try:
+            file_path = self.download_track(track_name, artist_name, staging_dir, bitrate)
+            if file_path.startswith(staging_dir + os.sep):
+                target = os.path.join(output_dir, os.path.basename(file_path))
+                shutil.move(file_path, target)
+                file_path = target
+                self._remember_path(track_name, artist_name, file_path)
+            return file_path
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
     def search_track(self, track_name, artist_name):
-        """Search for a track on Deezer."""
+        """Search for a track on Deezer, using the on-disk cache when possible."""
+        key = self._cache_key(track_name, artist_name)
+        with self._cache_lock:
+            cached = self._search_cache.get(key)
+        if cached:
+            print(f"🔍 Cached: {track_name} by {artist_name}")
+            return cached
+
         try:
             query = f"{track_name} {artist_name}"
             url = f"https://api.deezer.com/search?q={requests.utils.quote(query)}"
             
-            response = requests.get(url, timeout=10)
+            response = self.session.get(url, timeout=10)
             response.raise_for_status()
             
             data = response.json()
@@ -314,11 +527,22 @@ class DeemixDownloader:
             track_info = data['data'][0]
             print(f"🔍 Found: {track_info['title']} by {track_info['artist']['name']}")
             
+            with self._cache_lock:
+                self._search_cache[key] = track_info['link']
             return track_info['link']
             
         except Exception as e:
             raise Exception(f"Search failed: {str(e)}")
 
+    def close(self):
+        """Release this instance's hold on the shared caches and close the HTTP session."""
+        if self._closed:
+            return
+        self._closed = True
+        self._release_shelf(self.search_cache_file)
+        self._release_shelf(self.path_cache_file)
+        self.session.close()
+
     def setup_arl(self):
         """راه‌اندازی تعاملی ARL - فقط یک بار اجرا کنید."""
         print("\n" + "="*60)
@@ -1,66 +1,164 @@
 
+import asyncio
 import json
+import mmap
+import os
+import threading
+from collections import OrderedDict
+from importlib.util import find_spec
+import httpx
 import spotipy
 from spotipy.oauth2 import SpotifyClientCredentials
 from urllib.parse import urlparse
 
+try:
+    import orjson
+except ImportError:  # orjson اختیاری است؛ در نبودش از json استاندارد استفاده می‌شود
+    orjson = None
+
+# فقط فیلدهایی که واقعا استفاده می‌کنیم از اسپاتیفای گرفته می‌شوند
+PLAYLIST_FIELDS = 'items(track(name,id,artists(name))),next,total'
+PAGE_SIZE = 100
+TRACK_CACHE_SIZE = 4096
+API_URL = 'https://api.spotify.com/v1'
+# HTTP/2 فقط وقتی فعال می‌شود که پکیج h2 نصب باشد
+HTTP2 = find_spec('h2') is not None
+MAX_RETRIES = 3
+
 class SpotifyAPI:
     def __init__(self, client_id, client_secret):
         client_credentials_manager = SpotifyClientCredentials(client_id=client_id, client_secret=client_secret)
         self.sp = spotipy.Spotify(client_credentials_manager=client_credentials_manager)
+        # کش LRU برای اطلاعات ترک‌ها بر اساس ID؛ ترک‌های تکراری بین پلی‌لیست‌ها دوباره ساخته نمی‌شوند
+        self._track_cache = OrderedDict()
+        self._track_cache_lock = threading.Lock()
+        # کلاینت async مشترک بین همه پلی‌لیست‌ها تا اتصال‌های TLS دوباره استفاده شوند
+        self._http = None
 
-    def get_playlist_tracks(self, playlist_link):
+    @staticmethod
+    def _playlist_id(playlist_link):
         parsed_url = urlparse(playlist_link)
         if 'playlist' in parsed_url.path:
-            playlist_id = parsed_url.path.split('/')[-1]
-        else:
-            raise ValueError('Invalid playlist link')
-
-        results = self.sp.playlist_items(playlist_id)
-        tracks = []
-        while results:
-            for item in results['items']:
-                track = item['track']
-                tracks.append({
-                    'name': track['name'],
-                    'artists': [artist['name'] for artist in track['artists']],
-                    'id': track['id']
-                })
-            if results['next']:
-                results = self.sp.next(results)
-            else:
-                results = None
-        return tracks
+            return parsed_url.path.split('/')[-1]
+        raise ValueError('Invalid playlist link')
+
+    def _track_meta(self, track):
+        track_id = track['id']
+        with self._track_cache_lock:
+            cached = self._track_cache.get(track_id)
+            if cached is not None:
+                self._track_cache.move_to_end(track_id)
+                return cached
+
+        artists = [artist['name'] for artist in track['artists']]
+        meta = {
+            'name': track['name'],
+            'artists': artists,
+            # رشته نام هنرمندها یک بار اینجا ساخته می‌شود (برای جستجو و کپشن)
+            'artists_str': ', '.join(artists),
+            'id': track_id
+        }
+        # ترک‌های محلی ID ندارند و کش نمی‌شوند
+        if track_id is not None:
+            with self._track_cache_lock:
+                self._track_cache[track_id] = meta
+                if len(self._track_cache) > TRACK_CACHE_SIZE:
+                    self._track_cache.popitem(last=False)
+        return meta
+
+    def _client(self):
+        # به صورت تنبل ساخته می‌شود چون باید داخل event loop در حال اجرا باشد
+        if self._http is None:
+            self._http = httpx.AsyncClient(
+                base_url=API_URL,
+                http2=HTTP2,
+                limits=httpx.Limits(max_connections=10),
+                timeout=30
+            )
+        return self._http
+
+    async def _get(self, path, params):
+        # توکن توسط spotipy کش و در صورت انقضا تمدید می‌شود؛ تمدید درخواست شبکه است
+        token = await asyncio.to_thread(self.sp.auth_manager.get_access_token, as_dict=False)
+        for attempt in range(1, MAX_RETRIES + 1):
+            response = await self._client().get(
+                path, params=params, headers={'Authorization': f'Bearer {token}'}
+            )
+            if response.status_code != 429 or attempt == MAX_RETRIES:
+                break
+            await asyncio.sleep(int(response.headers.get('Retry-After', 1)))
+        response.raise_for_status()
+        return response.json()
+
+    async def get_playlist_snapshot_async(self, playlist_link):
+        playlist = await self._get(
+            f'/playlists/{self._playlist_id(playlist_link)}',
+            {'fields': 'snapshot_id,tracks.total'}
+        )
+        return playlist['snapshot_id'], playlist['tracks']['total']
+
+    async def get_playlist_tracks_async(self, playlist_link):
+        playlist_id = self._playlist_id(playlist_link)
+
+        first_page = await self._fetch_page_async(playlist_id, 0)
+        pages = [first_page]
+
+        # بقیه صفحات همزمان گرفته می‌شوند؛ تعداد اتصال‌ها را Limits کلاینت محدود می‌کند
+        if first_page['next']:
+            pages.extend(await asyncio.gather(*(
+                self._fetch_page_async(playlist_id, offset)
+                for offset in range(PAGE_SIZE, first_page['total'], PAGE_SIZE)
+            )))
+
+        return [self._track_meta(item['track']) for page in pages for item in page['items']]
+
+    def _fetch_page_async(self, playlist_id, offset):
+        return self._get(
+            f'/playlists/{playlist_id}/tracks',
+            {'fields': PLAYLIST_FIELDS, 'limit': PAGE_SIZE, 'offset': offset}
+        )
+
+    async def aclose(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
 
     def save_tracks_to_json(self, tracks, filename):
         try:
-            with open(filename, 'r', encoding='utf-8') as f:
-                existing_tracks = json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError):
+            # فایل به صورت mmap خوانده می‌شود تا کپی اضافه در حافظه ساخته نشود
+            with open(filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if orjson:
+                    with memoryview(mm) as view:
+                        existing_tracks = orjson.loads(view)
+                else:
+                    existing_tracks = json.loads(mm[:])
+        except (FileNotFoundError, ValueError):
             existing_tracks = []
 
         existing_ids = {track['id'] for track in existing_tracks}
+        new_ids = {track['id'] for track in tracks} - existing_ids
+
+        # اگر ترک جدیدی نیست، فایل دست نمی‌خورد
+        if not new_ids:
+            return []
 
         # ابتدا فلگ new همه ترک‌های موجود را False می‌کنیم
         for track in existing_tracks:
             track['new'] = False
 
-        new_tracks = []
-        for track in tracks:
-            if track['id'] not in existing_ids:
-                track['new'] = True
-                new_tracks.append(track)
-            else:
-                # برای ترک‌های موجود، فلگ new را حفظ می‌کنیم (که الان False است)
-                for et in existing_tracks:
-                    if et['id'] == track['id']:
-                        track['new'] = et.get('new', False)
-                        break
+        new_tracks = [dict(track, new=True) for track in tracks if track['id'] in new_ids]
 
         all_tracks = existing_tracks + new_tracks
 
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(all_tracks, f, ensure_ascii=False, indent=4)
+        if orjson:
+            payload = orjson.dumps(all_tracks, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+        else:
+            payload = json.dumps(all_tracks, ensure_ascii=False, indent=2).encode('utf-8')
+        # نوشتن در فایل موقت و جایگزینی اتمیک تا فایل نیمه‌کاره نماند
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            f.write(payload)
+        os.replace(tmp_filename, filename)
 
         return new_tracks
 
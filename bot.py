@@ -1,37 +1,146 @@
 import asyncio
+import atexit
 import json
 import os
 import logging
+import logging.handlers
+import queue
+import re
+import sqlite3
+import stat
 from pathlib import Path
-from typing import List, Tuple, Optional
-from dataclasses import dataclass, asdict
-from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Set, Tuple, Optional
+from dataclasses import dataclass
+from enum import IntEnum
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from datetime import datetime, timedelta
 
-from telegram import Update, Bot, InlineKeyboardButton, InlineKeyboardMarkup
+try:
+    import orjson
+except ImportError:  # optional: fall back to the stdlib json module
+    orjson = None
+
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputFile
 from telegram.ext import (
     Application,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
     ContextTypes,
+    ExtBot,
     filters
 )
-from telegram.error import TelegramError
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError, TimedOut
+from telegram.request import HTTPXRequest
 
-from SpotifyApiCall import SpotifyAPI
-from DeezerApiCall import DeemixDownloader
+from SpotifyApiCall import SpotifyAPI, HTTP2
+from DeezerApiCall import DeemixDownloader, _AUDIO_EXTS
 
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('bot.log', encoding='utf-8'),
-        logging.StreamHandler()
-    ]
-)
+# Handlers only enqueue records; file and console writes happen on the listener thread
+_log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+_log_handlers = [
+    logging.FileHandler('bot.log', encoding='utf-8'),
+    logging.StreamHandler()
+]
+for _handler in _log_handlers:
+    _handler.setFormatter(_log_formatter)
+
+_log_queue = queue.Queue(-1)
+_queue_handler = logging.handlers.QueueHandler(_log_queue)
+# Only merge args/tracebacks into the message; layout is applied by the listener
+_queue_handler.setFormatter(logging.Formatter('%(message)s'))
+logging.basicConfig(level=logging.INFO, handlers=[_queue_handler])
+_log_listener = logging.handlers.QueueListener(_log_queue, *_log_handlers)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
 logger = logging.getLogger(__name__)
 
+_SPOTIFY_PLAYLIST_RE = re.compile(
+    r'^https?://open\.spotify\.com/(?:intl-[a-z-]+/)?playlist/([A-Za-z0-9]+)'
+)
+
+
+def _extract_playlist_id(url: str) -> str:
+    """Spotify playlist ID from a playlist URL (the URL itself if it doesn't match)"""
+    match = _SPOTIFY_PLAYLIST_RE.match(url.strip())
+    return match.group(1) if match else url
+
+
+def _json_dumps(obj) -> bytes:
+    """Compact UTF-8 JSON, through orjson when it is installed"""
+    if orjson:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+
+def _json_loads(data):
+    """Parse JSON from bytes or str, through orjson when it is installed"""
+    return orjson.loads(data) if orjson else json.loads(data)
+
+
+def _write_atomic(path: str, data: bytes):
+    """Write bytes to path through a temp file and os.replace (no fsync)"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _fsync_path(path: str):
+    """fsync a file and its directory, so a prior os.replace survives power loss"""
+    for target in (path, os.path.dirname(os.path.abspath(path))):
+        fd = os.open(target, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+class RateLimiter:
+    """Async token bucket allowing `rate` acquisitions per `period` seconds"""
+    
+    def __init__(self, rate: int, period: float = 1.0):
+        self.rate = rate
+        self.period = period
+        self._tokens = float(rate)
+        self._updated: Optional[float] = None
+        self._lock = asyncio.Lock()
+    
+    async def acquire(self):
+        """Wait until a token is available and take it"""
+        loop = asyncio.get_running_loop()
+        async with self._lock:
+            while True:
+                now = loop.time()
+                if self._updated is not None:
+                    refill = (now - self._updated) * self.rate / self.period
+                    self._tokens = min(self.rate, self._tokens + refill)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) * self.period / self.rate)
+    
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+    
+    async def __aexit__(self, *exc):
+        return False
+
+
+class ChatState(IntEnum):
+    """Step of a multi-step admin conversation, kept in user_data['state']"""
+    AWAIT_PLAYLIST_URL = 1
+    AWAIT_PLAYLIST_NAME = 2
+    AWAIT_PLAYLIST_CHANNEL = 3
+    AWAIT_PLAYLIST_REMOVE = 4
+    AWAIT_CHANNEL_PLAYLIST = 5
+    AWAIT_CHANNEL_ID = 6
+
 
 @dataclass
 class PlaylistConfig:
@@ -43,20 +152,43 @@ class PlaylistConfig:
     channel_id: str
     last_check: Optional[str] = None
     track_count: int = 0
+    id: Optional[str] = None
 
 
 class ConfigManager:
     """Manages bot configuration and playlists"""
     
+    # Journal size at which it is folded back into config.json
+    COMPACT_THRESHOLD = 256 * 1024
+    
     def __init__(self, config_file: str = 'config.json'):
         self.config_file = config_file
+        # Mutations are appended here one JSON line each; config.json itself
+        # is only rewritten when the journal is compacted
+        self.journal_file = os.path.splitext(config_file)[0] + '.journal.jsonl'
         self.config = self._load_config()
+        # Index mirroring config['playlists'] for O(1) lookups by playlist ID,
+        # so URL variants (?si=..., intl-xx/) resolve to the same entry
+        for p in self.config['playlists']:
+            p.setdefault('id', _extract_playlist_id(p['url']))
+        self._by_id = {p['id']: p for p in self.config['playlists']}
+        
+        replayed = self._replay_journal()
+        self._journal = open(self.journal_file, 'ab', buffering=0)
+        self._journal_size = 0
+        # Start from an empty journal so a torn last line is never appended to
+        if replayed or os.path.getsize(self.journal_file) or not os.path.exists(config_file):
+            self.compact()
     
     def _load_config(self) -> dict:
         """Load configuration from file"""
-        if os.path.exists(self.config_file):
-            with open(self.config_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
+        try:
+            # One read of the whole file, parsed from bytes
+            with open(self.config_file, 'rb') as f:
+                data = f.read()
+            return _json_loads(data)
+        except FileNotFoundError:
+            pass
         return {
             'playlists': [],
             'settings': {
@@ -66,14 +198,77 @@ class ConfigManager:
             }
         }
     
+    def to_json(self) -> bytes:
+        """Serialize configuration (kept indented, it is edited by hand)"""
+        if orjson:
+            return orjson.dumps(self.config, option=orjson.OPT_INDENT_2)
+        return json.dumps(self.config, indent=2, ensure_ascii=False).encode('utf-8')
+    
     def save_config(self):
         """Save configuration to file"""
-        with open(self.config_file, 'w', encoding='utf-8') as f:
-            json.dump(self.config, f, indent=2, ensure_ascii=False)
+        _write_atomic(self.config_file, self.to_json())
+    
+    def _replay_journal(self) -> int:
+        """Apply mutations journaled since the last compaction"""
+        replayed = 0
+        try:
+            with open(self.journal_file, 'rb') as f:
+                for line in f:
+                    try:
+                        op = _json_loads(line)
+                    except ValueError:
+                        # Torn write from a crash mid-append; nothing follows it
+                        break
+                    self._apply(op)
+                    replayed += 1
+        except FileNotFoundError:
+            pass
+        return replayed
+    
+    def _apply(self, op: dict):
+        """Apply one mutation to the in-memory config"""
+        kind = op['op']
+        if kind == 'add':
+            entry = op['playlist']
+            if entry['id'] not in self._by_id:
+                self.config['playlists'].append(entry)
+                self._by_id[entry['id']] = entry
+        elif kind == 'remove':
+            if self._by_id.pop(op['id'], None) is not None:
+                self.config['playlists'] = [
+                    p for p in self.config['playlists'] if p['id'] != op['id']
+                ]
+        elif kind == 'update':
+            playlist = self._by_id.get(op['id'])
+            if playlist is not None:
+                playlist.update(op['fields'])
+    
+    def _record(self, op: dict):
+        """Apply a mutation and append it to the journal"""
+        self._apply(op)
+        line = _json_dumps(op) + b'\n'
+        self._journal.write(line)
+        self._journal_size += len(line)
+        if self._journal_size > self.COMPACT_THRESHOLD:
+            self.compact()
+    
+    def compact(self):
+        """Rewrite config.json with every mutation and empty the journal"""
+        self.save_config()
+        self._journal.truncate(0)
+        self._journal_size = 0
+    
+    def close(self):
+        """Compact, sync config.json to disk and close the journal"""
+        self.compact()
+        # Writes skip fsync on the hot path; sync once when shutting down
+        _fsync_path(self.config_file)
+        self._journal.close()
     
     def add_playlist(self, url: str, name: str, user_id: int, channel_id: str) -> bool:
         """Add a new playlist"""
-        if any(p['url'] == url for p in self.config['playlists']):
+        playlist_id = _extract_playlist_id(url)
+        if playlist_id in self._by_id:
             return False
         
         playlist = PlaylistConfig(
@@ -81,139 +276,251 @@ class ConfigManager:
             name=name,
             added_by=user_id,
             added_at=datetime.now().isoformat(),
-            channel_id=channel_id
+            channel_id=channel_id,
+            id=playlist_id
         )
-        self.config['playlists'].append(asdict(playlist))
-        self.save_config()
+        # vars() hands over the instance dict as-is; asdict() would deep-copy it
+        self._record({'op': 'add', 'playlist': vars(playlist)})
         return True
     
     def remove_playlist(self, url: str) -> bool:
         """Remove a playlist"""
-        original_length = len(self.config['playlists'])
-        self.config['playlists'] = [
-            p for p in self.config['playlists'] if p['url'] != url
-        ]
-        if len(self.config['playlists']) < original_length:
-            self.save_config()
-            return True
-        return False
+        playlist_id = _extract_playlist_id(url)
+        if playlist_id not in self._by_id:
+            return False
+        self._record({'op': 'remove', 'id': playlist_id})
+        return True
     
     def get_playlists(self) -> List[dict]:
         """Get all playlists"""
         return self.config['playlists']
     
+    def get_playlist(self, url: str) -> Optional[dict]:
+        """Get a playlist by URL"""
+        return self._by_id.get(_extract_playlist_id(url))
+    
     def get_playlist_channel(self, url: str) -> Optional[str]:
         """Get channel ID for a playlist"""
-        for playlist in self.config['playlists']:
-            if playlist['url'] == url:
-                return playlist['channel_id']
-        return None
+        playlist = self._by_id.get(_extract_playlist_id(url))
+        return playlist['channel_id'] if playlist else None
     
     def set_playlist_channel(self, url: str, channel_id: str) -> bool:
         """Set channel ID for a playlist"""
-        for playlist in self.config['playlists']:
-            if playlist['url'] == url:
-                playlist['channel_id'] = channel_id
-                self.save_config()
-                return True
-        return False
+        playlist = self._by_id.get(_extract_playlist_id(url))
+        if playlist is None:
+            return False
+        self._record({'op': 'update', 'id': playlist['id'], 'fields': {'channel_id': channel_id}})
+        return True
+    
+    def update_playlist_check(self, url: str, track_count: int) -> bool:
+        """Record the time and track count of the last check"""
+        playlist = self._by_id.get(_extract_playlist_id(url))
+        if playlist is None:
+            return False
+        self._record({'op': 'update', 'id': playlist['id'], 'fields': {
+            'last_check': datetime.now().isoformat(),
+            'track_count': track_count
+        }})
+        return True
 
 
-class SpotifyTelegramBot:
-    """Enhanced Telegram bot with playlist management"""
+class TracksDatabase:
+    """SQLite store for per-playlist tracks and counters"""
     
-    def __init__(self):
-        # Environment variables
-        self.telegram_token = os.getenv('TELEGRAM_TOKEN')
-        self.channel_id = os.getenv('CHANNEL_ID')
-        self.spotify_client_id = os.getenv('SPOTIFY_CLIENT_ID')
-        self.spotify_client_secret = os.getenv('SPOTIFY_CLIENT_SECRET')
-        self.admin_ids = [int(id.strip()) for id in os.getenv('ADMIN_IDS', '').split(',') if id.strip()]
-        self.deezer_arl = os.getenv('DEEZER_ARL', '')
-        
-        if not all([self.telegram_token, self.channel_id, 
-                   self.spotify_client_id, self.spotify_client_secret]):
-            raise ValueError("Missing required environment variables")
-        
-        # Initialize services
-        self.config_manager = ConfigManager()
-        self.spotify = SpotifyAPI(self.spotify_client_id, self.spotify_client_secret)
-        self.downloader = DeemixDownloader()
-        
-        # Setup Deezer ARL if provided
-        if self.deezer_arl:
-            try:
-                self.downloader.set_arl(self.deezer_arl)
-                logger.info("✅ Deezer ARL configured from environment")
-            except Exception as e:
-                logger.warning(f"⚠️ Failed to setup ARL from environment: {e}")
-        else:
-            logger.warning("⚠️ DEEZER_ARL not set in environment. Downloads will fail until configured.")
-        
-        # Setup download directory
-        self.download_dir = self.config_manager.config['settings']['download_dir']
-        Path(self.download_dir).mkdir(parents=True, exist_ok=True)
-        
-        # Track database
-        self.tracks_db_file = 'tracks_database.json'
-        self.tracks_db = self._load_tracks_db()
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS playlists (
+            url TEXT PRIMARY KEY,
+            snapshot_id TEXT,
+            total_tracks INTEGER NOT NULL DEFAULT 0,
+            sent_tracks INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS tracks (
+            playlist_url TEXT NOT NULL,
+            track_id TEXT NOT NULL,
+            name TEXT NOT NULL,
+            artists TEXT NOT NULL,
+            artists_str TEXT NOT NULL,
+            added_at TEXT NOT NULL,
+            sent INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (playlist_url, track_id)
+        ) WITHOUT ROWID;
+    """
+    
+    def __init__(self, db_file: str = 'tracks.db', legacy_file: str = 'tracks_database.json'):
+        self.db_file = db_file
+        self.conn = sqlite3.connect(db_file)
+        # WAL: commits append to the log instead of rewriting pages in place;
+        # NORMAL only fsyncs at checkpoints, which is still corruption-safe in WAL
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(self.SCHEMA)
+        self._import_legacy(legacy_file)
+    
+    def _import_legacy(self, legacy_file: str):
+        """One-time import of the old tracks_database.json"""
+        try:
+            with open(legacy_file, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        if self.conn.execute('SELECT 1 FROM playlists LIMIT 1').fetchone():
+            return
         
-        logger.info("🤖 Bot initialized successfully")
+        legacy = _json_loads(data)
+        with self.conn:
+            for url, playlist in legacy.items():
+                self.conn.execute(
+                    'INSERT INTO playlists (url, snapshot_id, total_tracks, sent_tracks) VALUES (?, ?, ?, ?)',
+                    (url, playlist.get('snapshot_id'), playlist.get('total_tracks', 0),
+                     playlist.get('sent_tracks', 0))
+                )
+                self.conn.executemany(
+                    'INSERT OR IGNORE INTO tracks VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (
+                        (url, track_id, t['name'], _json_dumps(t['artists']).decode('utf-8'),
+                         t.get('artists_str') or ', '.join(t['artists']),
+                         t.get('added_at', ''), int(t.get('sent', False)))
+                        for track_id, t in playlist.get('tracks', {}).items()
+                    )
+                )
+        os.replace(legacy_file, legacy_file + '.migrated')
+        logger.info(f"📦 Imported {len(legacy)} playlists from {legacy_file}")
     
-    def _load_tracks_db(self) -> dict:
-        """Load tracks database"""
-        if os.path.exists(self.tracks_db_file):
-            with open(self.tracks_db_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        return {}
+    def get_playlist(self, url: str) -> Optional[dict]:
+        """snapshot_id and counters of a playlist, None if never checked"""
+        row = self.conn.execute(
+            'SELECT snapshot_id, total_tracks, sent_tracks FROM playlists WHERE url = ?', (url,)
+        ).fetchone()
+        if row is None:
+            return None
+        return {'snapshot_id': row[0], 'total_tracks': row[1], 'sent_tracks': row[2]}
     
-    def _save_tracks_db(self):
-        """Save tracks database"""
-        with open(self.tracks_db_file, 'w', encoding='utf-8') as f:
-            json.dump(self.tracks_db, f, indent=2, ensure_ascii=False)
+    def counts(self, url: str) -> Tuple[int, int]:
+        """(total_tracks, sent_tracks) of a playlist"""
+        playlist = self.get_playlist(url)
+        return (playlist['total_tracks'], playlist['sent_tracks']) if playlist else (0, 0)
     
-    def is_admin(self, user_id: int) -> bool:
-        """Check if user is admin"""
-        return user_id in self.admin_ids
+    def track_ids(self, url: str) -> set:
+        """IDs of every track recorded for a playlist"""
+        return {row[0] for row in self.conn.execute(
+            'SELECT track_id FROM tracks WHERE playlist_url = ?', (url,)
+        )}
     
-    async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Handle /start command"""
-        user = update.effective_user
-        
-        # Create inline keyboard with quick actions
-        keyboard = []
-        
-        if self.is_admin(user.id):
-            keyboard = [
-                [
-                    InlineKeyboardButton("➕ افزودن پلی‌لیست", callback_data="add_playlist"),
-                    InlineKeyboardButton("📋 لیست پلی‌لیست‌ها", callback_data="list_playlists")
-                ],
-                [
-                    InlineKeyboardButton("🔄 چک و ارسال فوری", callback_data="check_now"),
-                    InlineKeyboardButton("📊 آمار", callback_data="show_stats")
-                ],
-                [
-                    InlineKeyboardButton("❌ حذف پلی‌لیست", callback_data="remove_playlist"),
-                    InlineKeyboardButton("❓ راهنما", callback_data="show_help")
-                ]
-            ]
-        else:
-            keyboard = [
-                [
-                    InlineKeyboardButton("📋 لیست پلی‌لیست‌ها", callback_data="list_playlists"),
-                    InlineKeyboardButton("📊 آمار", callback_data="show_stats")
-                ],
-                [
-                    InlineKeyboardButton("❓ راهنما", callback_data="show_help")
-                ]
-            ]
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        welcome_message = f"""
-👋 سلام {user.first_name}!
+    def add_tracks(self, url: str, tracks: List[dict], added_at: str):
+        """Record new tracks (already recorded IDs are ignored)"""
+        self.conn.executemany(
+            'INSERT OR IGNORE INTO tracks VALUES (?, ?, ?, ?, ?, ?, 0)',
+            (
+                (url, t['id'], t['name'], _json_dumps(t['artists']).decode('utf-8'),
+                 t['artists_str'], added_at)
+                for t in tracks
+            )
+        )
+    
+    def update_playlist(self, url: str, total_tracks: int, snapshot_id: Optional[str]):
+        """Store the latest track count and snapshot of a playlist"""
+        self.conn.execute(
+            'INSERT INTO playlists (url, snapshot_id, total_tracks) VALUES (?, ?, ?) '
+            'ON CONFLICT(url) DO UPDATE SET '
+            'snapshot_id = excluded.snapshot_id, total_tracks = excluded.total_tracks',
+            (url, snapshot_id, total_tracks)
+        )
+    
+    def mark_sent(self, url: str, track_id: str) -> bool:
+        """Flag a track as sent; the playlist's sent counter only counts it once"""
+        cursor = self.conn.execute(
+            'UPDATE tracks SET sent = 1 WHERE playlist_url = ? AND track_id = ? AND sent = 0',
+            (url, track_id)
+        )
+        if cursor.rowcount != 1:
+            return False
+        self.conn.execute(
+            'UPDATE playlists SET sent_tracks = sent_tracks + 1 WHERE url = ?', (url,)
+        )
+        return True
+    
+    def commit(self):
+        """Commit pending changes"""
+        self.conn.commit()
+    
+    def close(self):
+        """Commit and close the connection"""
+        self.conn.commit()
+        self.conn.close()
+
 
+class SpotifyTelegramBot:
+    """Enhanced Telegram bot with playlist management"""
+    
+    # Callback routing: exact callback_data (or the send_playlist_ prefix) -> handler
+    _SEND_PLAYLIST_PREFIX = 'send_playlist_'
+    _ADMIN_CALLBACKS = frozenset({
+        'add_playlist', 'remove_playlist', 'check_now',
+        'send_latest_playlist', _SEND_PLAYLIST_PREFIX
+    })
+    
+    # Attempts per upload when Telegram answers with RetryAfter or times out
+    _MAX_SEND_ATTEMPTS = 3
+    # Uploads in flight per playlist batch
+    _UPLOAD_WINDOW = 3
+    
+    # Slash command -> handler method, registered in one pass by run()
+    _COMMANDS = (
+        ("start", "start_command"),
+        ("help", "help_command"),
+        ("cancel", "cancel_command"),
+        ("addplaylist", "add_playlist_command"),
+        ("setchannel", "set_channel_command"),
+        ("listplaylists", "list_playlists_command"),
+        ("removeplaylist", "remove_playlist_command"),
+        ("checkplaylists", "check_playlists_command"),
+        ("stats", "stats_command"),
+        ("setuparl", "setup_arl_command"),
+        ("setarl", "set_arl_command"),
+    )
+    
+    _add_playlist_prompt = (
+        "لطفا لینک پلی‌لیست اسپاتیفای را ارسال کنید:\n"
+        "مثال: https://open.spotify.com/playlist/...\n\n"
+        "یا /cancel برای لغو"
+    )
+    
+    # Static menus and texts, built once at class load
+    _admin_markup = InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("➕ افزودن پلی‌لیست", callback_data="add_playlist"),
+            InlineKeyboardButton("📋 لیست پلی‌لیست‌ها", callback_data="list_playlists")
+        ],
+        [
+            InlineKeyboardButton("🔄 چک و ارسال فوری", callback_data="check_now"),
+            InlineKeyboardButton("📊 آمار", callback_data="show_stats")
+        ],
+        [
+            InlineKeyboardButton("❌ حذف پلی‌لیست", callback_data="remove_playlist"),
+            InlineKeyboardButton("❓ راهنما", callback_data="show_help")
+        ]
+    ])
+    _user_markup = InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("📋 لیست پلی‌لیست‌ها", callback_data="list_playlists"),
+            InlineKeyboardButton("📊 آمار", callback_data="show_stats")
+        ],
+        [
+            InlineKeyboardButton("❓ راهنما", callback_data="show_help")
+        ]
+    ])
+    _back_to_menu_markup = InlineKeyboardMarkup([[
+        InlineKeyboardButton("🔙 بازگشت به منو", callback_data="show_main_menu")
+    ]])
+    _check_all_row = (InlineKeyboardButton("🔄 چک و ارسال همه", callback_data="check_now"),)
+    _send_latest_markup = InlineKeyboardMarkup([[
+        InlineKeyboardButton("📤 ارسال فوری آهنگ‌های این پلی‌لیست", callback_data="send_latest_playlist")
+    ]])
+    _back_to_list_markup = InlineKeyboardMarkup([[
+        InlineKeyboardButton("🔙 بازگشت", callback_data="list_playlists")
+    ]])
+    
+    _start_text = """
 من یک ربات مدیریت پلی‌لیست اسپاتیفای هستم.
 
 📋 دستورات موجود:
@@ -225,13 +532,11 @@ class SpotifyTelegramBot:
 /stats - آمار ربات
 /help - راهنما
 
-{'⚠️ شما دسترسی ادمین ندارید.' if not self.is_admin(user.id) else '✅ شما ادمین هستید - از دکمه‌های زیر استفاده کنید:'}
 """
-        await update.message.reply_text(welcome_message, reply_markup=reply_markup)
+    _admin_start_text = _start_text + "✅ شما ادمین هستید - از دکمه‌های زیر استفاده کنید:\n"
+    _user_start_text = _start_text + "⚠️ شما دسترسی ادمین ندارید.\n"
     
-    async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Handle /help command"""
-        help_text = """
+    _help_text = """
 📖 راهنمای استفاده:
 
 1️⃣ افزودن پلی‌لیست:
@@ -264,7 +569,270 @@ class SpotifyTelegramBot:
 ⏰ ربات هر 6 ساعت به صورت خودکار پلی‌لیست‌ها را چک می‌کند.
 🎵 می‌توانید با دکمه‌های inline هر پلی‌لیست را جداگانه ارسال کنید.
 """
-        await update.message.reply_text(help_text)
+    
+    _callback_help_text = """
+📖 راهنمای استفاده:
+
+1️⃣ افزودن پلی‌لیست:
+/addplaylist یا دکمه "افزودن پلی‌لیست"
+
+2️⃣ تنظیم چنل:
+/setchannel یا دکمه "تنظیم چنل"
+
+3️⃣ مشاهده پلی‌لیست‌ها:
+/listplaylists یا دکمه "لیست پلی‌لیست‌ها"
+
+4️⃣ ارسال فوری:
+از دکمه "ارسال فوری" کنار هر پلی‌لیست
+
+5️⃣ چک همه:
+دکمه "چک و ارسال همه"
+
+⏰ ربات هر 6 ساعت به صورت خودکار چک می‌کند.
+"""
+    
+    def __init__(self):
+        # Environment variables
+        self.telegram_token = os.getenv('TELEGRAM_TOKEN')
+        self.channel_id = os.getenv('CHANNEL_ID')
+        self.spotify_client_id = os.getenv('SPOTIFY_CLIENT_ID')
+        self.spotify_client_secret = os.getenv('SPOTIFY_CLIENT_SECRET')
+        self.admin_ids = frozenset(int(id.strip()) for id in os.getenv('ADMIN_IDS', '').split(',') if id.strip())
+        self.deezer_arl = os.getenv('DEEZER_ARL', '')
+        
+        if not all([self.telegram_token, self.channel_id, 
+                   self.spotify_client_id, self.spotify_client_secret]):
+            raise ValueError("Missing required environment variables")
+        
+        # Pending writes, flushed in the background by _writer_loop
+        self._dirty = asyncio.Event()
+        self._tracks_dirty = False
+        self._writer_task: Optional[asyncio.Task] = None
+        
+        # Bound concurrent uploads and stay under Telegram's ~30 msg/s limit
+        self._send_sem = asyncio.Semaphore(8)
+        self._rate = RateLimiter(30, 1)
+        # Telegram allows ~20 messages a minute into one group/channel
+        self._channel_limits: Dict[str, RateLimiter] = {}
+        
+        # Per-chat outgoing queues for callback replies and admin notices (1 msg/s per chat)
+        self._chat_queues: Dict[int, asyncio.Queue] = {}
+        self._chat_workers: Dict[int, asyncio.Task] = {}
+        
+        self._callback_handlers: Dict[str, Callable[..., Awaitable]] = {
+            'add_playlist': self._cb_add_playlist,
+            'list_playlists': self._cb_list_playlists,
+            'remove_playlist': self._cb_remove_playlist,
+            'check_now': self._cb_check_now,
+            'show_stats': self._cb_show_stats,
+            'show_help': self._cb_show_help,
+            self._SEND_PLAYLIST_PREFIX: self._cb_send_playlist,
+            'send_latest_playlist': self._cb_send_latest_playlist,
+            'show_main_menu': self._cb_show_main_menu,
+        }
+        
+        # Multi-step conversation: user_data['state'] -> text message handler
+        self._state_handlers: Dict[ChatState, Callable[..., Awaitable]] = {
+            ChatState.AWAIT_PLAYLIST_URL: self._on_playlist_url,
+            ChatState.AWAIT_PLAYLIST_NAME: self._on_playlist_name,
+            ChatState.AWAIT_PLAYLIST_CHANNEL: self._on_playlist_channel,
+            ChatState.AWAIT_PLAYLIST_REMOVE: self._on_playlist_remove,
+            ChatState.AWAIT_CHANNEL_PLAYLIST: self._on_channel_playlist,
+            ChatState.AWAIT_CHANNEL_ID: self._on_channel_id,
+        }
+        
+        # Manual checks wake periodic_check instead of running a second full check
+        self._check_trigger = asyncio.Event()
+        self._check_waiters: List[asyncio.Future] = []
+        self._periodic_task: Optional[asyncio.Task] = None
+        # Tasks inside check_playlist, cancelled on shutdown before the DB closes
+        self._running_checks: Set[asyncio.Task] = set()
+        
+        # Serializes checks of the same playlist (manual and periodic can overlap)
+        self._check_locks: Dict[str, asyncio.Lock] = {}
+        
+        # Initialize services
+        # One Bot (and HTTPX connection pool) shared by the Application's
+        # handlers and all outgoing sends; run() hands it to the builder
+        self.bot = ExtBot(
+            token=self.telegram_token,
+            request=HTTPXRequest(
+                connection_pool_size=64,
+                pool_timeout=30,
+                http_version='2' if HTTP2 else '1.1'
+            )
+        )
+        self.config_manager = ConfigManager()
+        self.spotify = SpotifyAPI(self.spotify_client_id, self.spotify_client_secret)
+        self.downloader = DeemixDownloader()
+        # Download batches block a thread for minutes; keep them off the default
+        # executor that to_thread file I/O (audio reads, unlinks, .env writes) relies on
+        self._download_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix='download')
+        
+        # Setup Deezer ARL if provided
+        if self.deezer_arl:
+            try:
+                self.downloader.set_arl(self.deezer_arl)
+                logger.info("✅ Deezer ARL configured from environment")
+            except Exception as e:
+                logger.warning(f"⚠️ Failed to setup ARL from environment: {e}")
+        else:
+            logger.warning("⚠️ DEEZER_ARL not set in environment. Downloads will fail until configured.")
+        
+        # Setup download directory
+        self.download_dir = self.config_manager.config['settings']['download_dir']
+        Path(self.download_dir).mkdir(parents=True, exist_ok=True)
+        # process_new_tracks calls currently downloading into download_dir
+        self._active_downloads = 0
+        
+        # Track database
+        self.tracks = TracksDatabase()
+        
+        # Running totals for /stats, kept in sync by _bump_tracks
+        self._reset_stats()
+        
+        logger.info("🤖 Bot initialized successfully")
+    
+    def _mark_tracks_dirty(self):
+        """Schedule a commit of the tracks database by the background writer"""
+        self._tracks_dirty = True
+        self._dirty.set()
+    
+    async def _flush(self):
+        """Write whatever is dirty"""
+        if self._tracks_dirty:
+            self._tracks_dirty = False
+            # Rows are already written; this only commits the transaction
+            self.tracks.commit()
+    
+    async def _writer_loop(self):
+        """Persist changes in the background, coalescing bursts of writes"""
+        while True:
+            await self._dirty.wait()
+            await asyncio.sleep(0.5)
+            self._dirty.clear()
+            try:
+                await self._flush()
+            except Exception as e:
+                logger.error(f"Error saving data: {e}", exc_info=True)
+    
+    async def _post_init(self, app: Application):
+        """Start background tasks once the event loop is running"""
+        self._writer_task = asyncio.create_task(self._writer_loop())
+    
+    async def _post_shutdown(self, app: Application):
+        """Stop the writer, flush pending changes and release resources"""
+        # Checks write to the DB; stop them before it is closed below
+        checks = [t for t in (self._periodic_task, *self._running_checks) if t]
+        for task in checks:
+            task.cancel()
+        await asyncio.gather(*checks, return_exceptions=True)
+        
+        workers = list(self._chat_workers.values())
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        
+        if self._writer_task:
+            self._writer_task.cancel()
+        await self._flush()
+        self.tracks.close()
+        self.config_manager.close()
+        await self.spotify.aclose()
+        self._download_pool.shutdown(wait=False, cancel_futures=True)
+        await asyncio.to_thread(self.downloader.close)
+    
+    async def _enqueue(self, chat_id: int, coro: Awaitable) -> Any:
+        """Run an outgoing chat call through that chat's rate-limited queue"""
+        queue = self._chat_queues.get(chat_id)
+        if queue is None:
+            queue = self._chat_queues[chat_id] = asyncio.Queue()
+        worker = self._chat_workers.get(chat_id)
+        if worker is None or worker.done():
+            self._chat_workers[chat_id] = asyncio.create_task(self._chat_worker(chat_id, queue))
+        
+        future = asyncio.get_running_loop().create_future()
+        queue.put_nowait((coro, future))
+        return await future
+    
+    async def _chat_worker(self, chat_id: int, queue: asyncio.Queue):
+        """Drain one chat's queue; exits after a minute of inactivity"""
+        limiter = RateLimiter(1, 1)
+        while True:
+            try:
+                coro, future = await asyncio.wait_for(queue.get(), timeout=60)
+            except asyncio.TimeoutError:
+                if queue.empty():
+                    del self._chat_queues[chat_id]
+                    del self._chat_workers[chat_id]
+                    return
+                continue
+            
+            # The caller may have been cancelled while its call was queued or in flight
+            if future.done():
+                coro.close()
+                continue
+            async with limiter, self._rate:
+                try:
+                    result = await coro
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    if not future.done():
+                        future.set_result(result)
+    
+    @staticmethod
+    def _numbered_prompt(header: str, playlists: List[dict]) -> str:
+        """Prompt listing playlists by number, ending with the /cancel hint"""
+        parts = [header]
+        parts.extend(f"{i}. {playlist['name']}\n" for i, playlist in enumerate(playlists, 1))
+        parts.append("\nیا /cancel برای لغو")
+        return ''.join(parts)
+    
+    @staticmethod
+    def _format_last_check(playlist: dict) -> str:
+        """Format a playlist's last_check timestamp for display"""
+        last_check = playlist.get('last_check')
+        if not last_check:
+            return 'هرگز'
+        # ISO timestamps are written by us, so slicing gives '%Y-%m-%d %H:%M'
+        return last_check[:16].replace('T', ' ')
+    
+    def is_admin(self, user_id: int) -> bool:
+        """Check if user is admin"""
+        return user_id in self.admin_ids
+    
+    def _main_menu(self, user) -> Tuple[str, InlineKeyboardMarkup]:
+        """Welcome text and pre-built keyboard for a user's role"""
+        if self.is_admin(user.id):
+            body, reply_markup = self._admin_start_text, self._admin_markup
+        else:
+            body, reply_markup = self._user_start_text, self._user_markup
+        return f"\n👋 سلام {user.first_name}!\n{body}", reply_markup
+    
+    async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle /start command"""
+        welcome_message, reply_markup = self._main_menu(update.effective_user)
+        await update.message.reply_text(welcome_message, reply_markup=reply_markup)
+    
+    async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle /help command"""
+        await update.message.reply_text(self._help_text)
+    
+    async def cancel_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle /cancel command"""
+        context.user_data.clear()
+        await update.message.reply_text("❌ عملیات لغو شد.")
+    
+    async def add_playlist_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle /addplaylist command"""
+        if not self.is_admin(update.effective_user.id):
+            await update.message.reply_text("⛔️ فقط ادمین‌ها می‌توانند پلی‌لیست اضافه کنند.")
+            return
+        
+        await update.message.reply_text(self._add_playlist_prompt)
+        context.user_data['state'] = ChatState.AWAIT_PLAYLIST_URL
     
     async def set_channel_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /setchannel command"""
@@ -277,13 +845,10 @@ class SpotifyTelegramBot:
             await update.message.reply_text("📭 هیچ پلی‌لیستی برای تنظیم چنل وجود ندارد.")
             return
         
-        message = "برای تنظیم چنل، شماره پلی‌لیست را ارسال کنید:\n\n"
-        for i, playlist in enumerate(playlists, 1):
-            message += f"{i}. {playlist['name']}\n"
-        message += "\nیا /cancel برای لغو"
+        message = self._numbered_prompt("برای تنظیم چنل، شماره پلی‌لیست را ارسال کنید:\n\n", playlists)
         
         await update.message.reply_text(message)
-        context.user_data['awaiting_channel_playlist'] = True
+        context.user_data['state'] = ChatState.AWAIT_CHANNEL_PLAYLIST
     
     async def list_playlists_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /listplaylists command"""
@@ -293,38 +858,30 @@ class SpotifyTelegramBot:
             await update.message.reply_text("📭 هیچ پلی‌لیستی ثبت نشده است.")
             return
         
-        message = "📋 پلی‌لیست‌های ثبت شده:\n\n"
+        parts = ["📋 پلی‌لیست‌های ثبت شده:\n\n"]
+        is_admin = self.is_admin(update.effective_user.id)
         
         # Create inline keyboard for each playlist
         keyboard = []
         
         for i, playlist in enumerate(playlists, 1):
-            last_check = playlist.get('last_check', 'هرگز')
-            if last_check != 'هرگز':
-                last_check = datetime.fromisoformat(last_check).strftime('%Y-%m-%d %H:%M')
-            
-            message += f"{i}. 🎵 {playlist['name']}\n"
-            message += f"   📊 تعداد آهنگ: {playlist.get('track_count', 0)}\n"
-            message += f"   🕐 آخرین چک: {last_check}\n"
-            message += f"   🔗 {playlist['url']}\n\n"
+            parts.append(
+                f"{i}. 🎵 {playlist['name']}\n"
+                f"   📊 تعداد آهنگ: {playlist.get('track_count', 0)}\n"
+                f"   🕐 آخرین چک: {self._format_last_check(playlist)}\n"
+                f"   🔗 {playlist['url']}\n\n"
+            )
             
             # Add button for each playlist to send immediately
-            if self.is_admin(update.effective_user.id):
-                keyboard.append([
-                    InlineKeyboardButton(
-                        f"📤 ارسال فوری: {playlist['name'][:20]}...",
-                        callback_data=f"send_playlist_{i-1}"
-                    )
-                ])
+            if is_admin:
+                keyboard.append(self._send_button_row("📤 ارسال فوری", playlist['name'], i - 1))
         
         # Add general check button
-        if self.is_admin(update.effective_user.id):
-            keyboard.append([
-                InlineKeyboardButton("🔄 چک و ارسال همه", callback_data="check_now")
-            ])
+        if is_admin:
+            keyboard.append(self._check_all_row)
         
         reply_markup = InlineKeyboardMarkup(keyboard) if keyboard else None
-        await update.message.reply_text(message, reply_markup=reply_markup)
+        await update.message.reply_text(''.join(parts), reply_markup=reply_markup)
     
     async def remove_playlist_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /removeplaylist command"""
@@ -337,13 +894,10 @@ class SpotifyTelegramBot:
             await update.message.reply_text("📭 هیچ پلی‌لیستی برای حذف وجود ندارد.")
             return
         
-        message = "برای حذف، شماره پلی‌لیست را ارسال کنید:\n\n"
-        for i, playlist in enumerate(playlists, 1):
-            message += f"{i}. {playlist['name']}\n"
-        message += "\nیا /cancel برای لغو"
+        message = self._numbered_prompt("برای حذف، شماره پلی‌لیست را ارسال کنید:\n\n", playlists)
         
         await update.message.reply_text(message)
-        context.user_data['awaiting_playlist_remove'] = True
+        context.user_data['state'] = ChatState.AWAIT_PLAYLIST_REMOVE
     
     async def check_playlists_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /checkplaylists command"""
@@ -352,31 +906,57 @@ class SpotifyTelegramBot:
             return
         
         await update.message.reply_text("🔄 در حال چک پلی‌لیست‌ها...")
-        await self.check_all_playlists()
+        await self._request_check()
         await update.message.reply_text("✅ چک پلی‌لیست‌ها تکمیل شد.")
     
+    def _playlist_counts(self, url: str) -> Tuple[int, int]:
+        """(total_tracks, sent_tracks) stored for a playlist"""
+        return self.tracks.counts(url)
+    
+    def _reset_stats(self):
+        """Recompute the running stats totals from the tracks database"""
+        self._stats_total_tracks = 0
+        self._stats_total_sent = 0
+        for playlist in self.config_manager.get_playlists():
+            self._bump_tracks(*self._playlist_counts(playlist['url']))
+    
+    def _bump_tracks(self, total_delta: int = 0, sent_delta: int = 0):
+        """Adjust the running stats totals"""
+        self._stats_total_tracks += total_delta
+        self._stats_total_sent += sent_delta
+    
+    def _build_stats_message(self, with_arl: bool = False) -> str:
+        """Render the stats text from the running totals"""
+        # Check ARL status
+        arl_status = ("✅ فعال" if self.deezer_arl else "❌ تنظیم نشده") if with_arl else None
+        return self._render_stats(
+            len(self.config_manager.get_playlists()),
+            self._stats_total_tracks,
+            self._stats_total_sent,
+            arl_status
+        )
+    
+    @staticmethod
+    @lru_cache(maxsize=64)
+    def _render_stats(playlist_count: int, total_tracks: int, total_sent: int,
+                      arl_status: Optional[str]) -> str:
+        """Stats text for the given totals; repeat clicks reuse the cached string"""
+        lines = [
+            "\n📊 آمار ربات:\n",
+            f"🎵 تعداد پلی‌لیست‌ها: {playlist_count}",
+            f"🎼 کل آهنگ‌ها: {total_tracks}",
+            f"✅ آهنگ‌های ارسال شده: {total_sent}",
+            "⏰ بازه چک: 6 ساعت",
+            "🎚️ کیفیت: 128kbps",
+        ]
+        if arl_status:
+            lines.append(f"🎧 Deezer ARL: {arl_status}")
+        lines.append("")
+        return '\n'.join(lines)
+    
     async def stats_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /stats command"""
-        playlists = self.config_manager.get_playlists()
-        total_tracks = sum(self.tracks_db.get(p['url'], {}).get('total_tracks', 0) 
-                          for p in playlists)
-        total_sent = sum(self.tracks_db.get(p['url'], {}).get('sent_tracks', 0) 
-                        for p in playlists)
-        
-        # Check ARL status
-        arl_status = "✅ فعال" if self.deezer_arl else "❌ تنظیم نشده"
-        
-        stats_message = f"""
-📊 آمار ربات:
-
-🎵 تعداد پلی‌لیست‌ها: {len(playlists)}
-🎼 کل آهنگ‌ها: {total_tracks}
-✅ آهنگ‌های ارسال شده: {total_sent}
-⏰ بازه چک: 6 ساعت
-🎚️ کیفیت: 128kbps
-🎧 Deezer ARL: {arl_status}
-"""
-        await update.message.reply_text(stats_message)
+        await update.message.reply_text(self._build_stats_message(with_arl=True))
     
     async def setup_arl_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /setuparl command"""
@@ -400,15 +980,20 @@ class SpotifyTelegramBot:
 """
         await update.message.reply_text(help_text)
     
+    @staticmethod
+    async def _delete_message(message):
+        """Delete a message, logging instead of raising on failure"""
+        try:
+            await message.delete()
+        except TelegramError as e:
+            logger.warning(f"Could not delete message: {e}")
+    
     async def set_arl_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /setarl command"""
         if not self.is_admin(update.effective_user.id):
             await update.message.reply_text("⛔️ فقط ادمین‌ها می‌توانند ARL را تنظیم کنند.")
             # Delete user's message for security
-            try:
-                await update.message.delete()
-            except:
-                pass
+            context.application.create_task(self._delete_message(update.message))
             return
         
         if not context.args:
@@ -421,34 +1006,16 @@ class SpotifyTelegramBot:
         
         arl_token = context.args[0]
         
-        # Delete the message containing ARL for security
-        try:
-            await update.message.delete()
-        except:
-            pass
+        # Delete the message containing ARL for security, without holding up the reply
+        context.application.create_task(self._delete_message(update.message))
         
         try:
-            # Setup ARL in downloader
-            self.downloader.set_arl(arl_token)
+            # Setup ARL in downloader (writes the deemix .arl file)
+            await asyncio.to_thread(self.downloader.set_arl, arl_token)
             self.deezer_arl = arl_token
             
             # Save to environment file for persistence
-            env_file = '.env'
-            if os.path.exists(env_file):
-                with open(env_file, 'r') as f:
-                    lines = f.readlines()
-                
-                with open(env_file, 'w') as f:
-                    arl_found = False
-                    for line in lines:
-                        if line.startswith('DEEZER_ARL='):
-                            f.write(f'DEEZER_ARL={arl_token}\n')
-                            arl_found = True
-                        else:
-                            f.write(line)
-                    
-                    if not arl_found:
-                        f.write(f'\nDEEZER_ARL={arl_token}\n')
+            await asyncio.to_thread(self._save_arl_to_env, '.env', arl_token)
             
             await context.bot.send_message(
                 chat_id=update.effective_chat.id,
@@ -464,206 +1031,228 @@ class SpotifyTelegramBot:
             )
             logger.error(f"Failed to setup ARL: {e}")
     
+    @staticmethod
+    def _save_arl_to_env(env_file: str, arl_token: str):
+        """Rewrite DEEZER_ARL in env_file line by line through a temp file"""
+        if not os.path.exists(env_file):
+            return
+        
+        tmp_file = env_file + '.tmp'
+        # .env holds secrets; the temp file takes the original's mode, not the umask default
+        mode = stat.S_IMODE(os.stat(env_file).st_mode)
+        try:
+            flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+            with open(env_file, 'r') as src, open(os.open(tmp_file, flags, mode), 'w') as dst:
+                arl_found = False
+                for line in src:
+                    if line.startswith('DEEZER_ARL='):
+                        dst.write(f'DEEZER_ARL={arl_token}\n')
+                        arl_found = True
+                    else:
+                        dst.write(line)
+                
+                if not arl_found:
+                    dst.write(f'\nDEEZER_ARL={arl_token}\n')
+            os.chmod(tmp_file, mode)
+            os.replace(tmp_file, env_file)
+        except OSError:
+            try:
+                os.remove(tmp_file)
+            except OSError:
+                pass
+            raise
+    
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle text messages"""
-        user_data = context.user_data
-        text = update.message.text
-        
-        if text == '/cancel':
-            user_data.clear()
-            await update.message.reply_text("❌ عملیات لغو شد.")
+        # Plain chat outside any multi-step flow has no state and is ignored
+        handler = self._state_handlers.get(context.user_data.get('state'))
+        if handler:
+            await handler(update, context.user_data, update.message.text)
+    
+    async def _on_playlist_url(self, update: Update, user_data: dict, text: str):
+        """Handle playlist URL input"""
+        match = _SPOTIFY_PLAYLIST_RE.match(text.strip())
+        if not match:
+            await update.message.reply_text("❌ لینک نامعتبر است. لطفا یک لینک معتبر ارسال کنید.")
             return
         
-        # Handle playlist URL input
-        if user_data.get('awaiting_playlist_url'):
-            if 'spotify.com/playlist' not in text:
-                await update.message.reply_text("❌ لینک نامعتبر است. لطفا یک لینک معتبر ارسال کنید.")
-                return
-            
-            user_data['playlist_url'] = text
-            user_data['awaiting_playlist_url'] = False
-            user_data['awaiting_playlist_name'] = True
-            await update.message.reply_text("✅ لینک دریافت شد.\nحالا یک نام برای این پلی‌لیست وارد کنید:")
+        # Canonical URL (no ?si= tracking params) so duplicates are detected
+        user_data['playlist_url'] = f"https://open.spotify.com/playlist/{match.group(1)}"
+        user_data['state'] = ChatState.AWAIT_PLAYLIST_NAME
+        await update.message.reply_text("✅ لینک دریافت شد.\nحالا یک نام برای این پلی‌لیست وارد کنید:")
+    
+    async def _on_playlist_name(self, update: Update, user_data: dict, text: str):
+        """Handle playlist name input"""
+        url = user_data.get('playlist_url')
+        name = text
+        
+        user_data['playlist_name'] = name
+        user_data['state'] = ChatState.AWAIT_PLAYLIST_CHANNEL
+        
+        await update.message.reply_text(
+            f"✅ لینک و نام دریافت شد.\n"
+            f"حالا ID چنل مورد نظر را ارسال کنید:\n"
+            f"مثال: @channelname یا -1001234567890\n\n"
+            f"یا /cancel برای لغو"
+        )
+    
+    async def _on_playlist_channel(self, update: Update, user_data: dict, text: str):
+        """Handle playlist channel input"""
+        channel_id = text.strip()
+        
+        # Handle @username format
+        if channel_id.startswith('@'):
+            channel_id = channel_id[1:]  # Remove @ symbol
+        
+        # Basic validation
+        if not channel_id or len(channel_id) < 3:
+            await update.message.reply_text("❌ ID چنل نامعتبر است.")
             return
         
-        # Handle playlist name input
-        if user_data.get('awaiting_playlist_name'):
-            url = user_data.get('playlist_url')
-            name = text
-            
-            user_data['playlist_name'] = name
-            user_data['awaiting_playlist_name'] = False
-            user_data['awaiting_playlist_channel'] = True
-            
+        url = user_data.get('playlist_url')
+        name = user_data.get('playlist_name')
+        
+        if self.config_manager.add_playlist(url, name, update.effective_user.id, channel_id):
+            self._bump_tracks(*self._playlist_counts(url))
             await update.message.reply_text(
-                f"✅ لینک و نام دریافت شد.\n"
-                f"حالا ID چنل مورد نظر را ارسال کنید:\n"
-                f"مثال: @channelname یا -1001234567890\n\n"
-                f"یا /cancel برای لغو"
+                f"✅ پلی‌لیست '{name}' با موفقیت اضافه شد!\n"
+                f"چنل تنظیم شده: {channel_id}\n\n"
+                f"می‌خواهید الان آهنگ‌های آن را چک و ارسال کنید؟",
+                reply_markup=self._send_latest_markup
             )
-            return
+        else:
+            await update.message.reply_text("⚠️ این پلی‌لیست قبلا اضافه شده است.")
         
-        # Handle playlist channel input
-        if user_data.get('awaiting_playlist_channel'):
-            channel_id = text.strip()
-            
-            # Handle @username format
-            if channel_id.startswith('@'):
-                channel_id = channel_id[1:]  # Remove @ symbol
-            
-            # Basic validation
-            if not channel_id or len(channel_id) < 3:
-                await update.message.reply_text("❌ ID چنل نامعتبر است.")
-                return
+        user_data.clear()
+    
+    async def _on_playlist_remove(self, update: Update, user_data: dict, text: str):
+        """Handle playlist removal"""
+        try:
+            index = int(text) - 1
+            playlists = self.config_manager.get_playlists()
             
-            url = user_data.get('playlist_url')
-            name = user_data.get('playlist_name')
+            if 0 <= index < len(playlists):
+                playlist = playlists[index]
+                if self.config_manager.remove_playlist(playlist['url']):
+                    total, sent = self._playlist_counts(playlist['url'])
+                    self._bump_tracks(-total, -sent)
+                    await update.message.reply_text(f"✅ پلی‌لیست '{playlist['name']}' حذف شد.")
+                else:
+                    await update.message.reply_text("❌ خطا در حذف پلی‌لیست.")
+            else:
+                await update.message.reply_text("❌ شماره نامعتبر است.")
+        except ValueError:
+            await update.message.reply_text("❌ لطفا یک عدد معتبر وارد کنید.")
+        
+        user_data.clear()
+    
+    async def _on_channel_playlist(self, update: Update, user_data: dict, text: str):
+        """Handle channel playlist selection"""
+        try:
+            index = int(text) - 1
+            playlists = self.config_manager.get_playlists()
             
-            if self.config_manager.add_playlist(url, name, update.effective_user.id, channel_id):
-                keyboard = [[
-                    InlineKeyboardButton("📤 ارسال فوری آهنگ‌های این پلی‌لیست", callback_data="send_latest_playlist")
-                ]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
+            if 0 <= index < len(playlists):
+                playlist = playlists[index]
+                user_data['selected_playlist_url'] = playlist['url']
+                user_data['state'] = ChatState.AWAIT_CHANNEL_ID
                 
                 await update.message.reply_text(
-                    f"✅ پلی‌لیست '{name}' با موفقیت اضافه شد!\n"
-                    f"چنل تنظیم شده: {channel_id}\n\n"
-                    f"می‌خواهید الان آهنگ‌های آن را چک و ارسال کنید؟",
-                    reply_markup=reply_markup
+                    f"✅ پلی‌لیست '{playlist['name']}' انتخاب شد.\n"
+                    f"حالا ID چنل مورد نظر را ارسال کنید:\n"
+                    f"مثال: @channelname یا -1001234567890"
                 )
             else:
-                await update.message.reply_text("⚠️ این پلی‌لیست قبلا اضافه شده است.")
-            
-            user_data.clear()
-            return
+                await update.message.reply_text("❌ شماره نامعتبر است.")
+        except ValueError:
+            await update.message.reply_text("❌ لطفا یک عدد معتبر وارد کنید.")
+    
+    async def _on_channel_id(self, update: Update, user_data: dict, text: str):
+        """Handle channel ID input"""
+        channel_id = text.strip()
         
-        # Handle playlist removal
-        if user_data.get('awaiting_playlist_remove'):
-            try:
-                index = int(text) - 1
-                playlists = self.config_manager.get_playlists()
-                
-                if 0 <= index < len(playlists):
-                    playlist = playlists[index]
-                    if self.config_manager.remove_playlist(playlist['url']):
-                        await update.message.reply_text(f"✅ پلی‌لیست '{playlist['name']}' حذف شد.")
-                    else:
-                        await update.message.reply_text("❌ خطا در حذف پلی‌لیست.")
-                else:
-                    await update.message.reply_text("❌ شماره نامعتبر است.")
-            except ValueError:
-                await update.message.reply_text("❌ لطفا یک عدد معتبر وارد کنید.")
-            
-            user_data.clear()
-            return
+        # Handle @username format
+        if channel_id.startswith('@'):
+            channel_id = channel_id[1:]  # Remove @ symbol
         
-        # Handle channel playlist selection
-        if user_data.get('awaiting_channel_playlist'):
-            try:
-                index = int(text) - 1
-                playlists = self.config_manager.get_playlists()
-                
-                if 0 <= index < len(playlists):
-                    playlist = playlists[index]
-                    user_data['selected_playlist_url'] = playlist['url']
-                    user_data['awaiting_channel_playlist'] = False
-                    user_data['awaiting_channel_id'] = True
-                    
-                    await update.message.reply_text(
-                        f"✅ پلی‌لیست '{playlist['name']}' انتخاب شد.\n"
-                        f"حالا ID چنل مورد نظر را ارسال کنید:\n"
-                        f"مثال: @channelname یا -1001234567890"
-                    )
-                else:
-                    await update.message.reply_text("❌ شماره نامعتبر است.")
-            except ValueError:
-                await update.message.reply_text("❌ لطفا یک عدد معتبر وارد کنید.")
-            
+        # Basic validation
+        if not channel_id or len(channel_id) < 3:
+            await update.message.reply_text("❌ ID چنل نامعتبر است.")
             return
         
-        # Handle channel ID input
-        if user_data.get('awaiting_channel_id'):
-            channel_id = text.strip()
-            
-            # Handle @username format
-            if channel_id.startswith('@'):
-                channel_id = channel_id[1:]  # Remove @ symbol
-            
-            # Basic validation
-            if not channel_id or len(channel_id) < 3:
-                await update.message.reply_text("❌ ID چنل نامعتبر است.")
-                return
-            
-            playlist_url = user_data.get('selected_playlist_url')
-            
-            if self.config_manager.set_playlist_channel(playlist_url, channel_id):
-                playlist_name = None
-                for playlist in self.config_manager.get_playlists():
-                    if playlist['url'] == playlist_url:
-                        playlist_name = playlist['name']
-                        break
-                
-                await update.message.reply_text(
-                    f"✅ چنل برای پلی‌لیست '{playlist_name}' تنظیم شد: {channel_id}"
-                )
-            else:
-                await update.message.reply_text("❌ خطا در تنظیم چنل.")
+        playlist_url = user_data.get('selected_playlist_url')
+        
+        if self.config_manager.set_playlist_channel(playlist_url, channel_id):
+            playlist_name = self.config_manager.get_playlist(playlist_url)['name']
             
-            user_data.clear()
-            return
+            await update.message.reply_text(
+                f"✅ چنل برای پلی‌لیست '{playlist_name}' تنظیم شد: {channel_id}"
+            )
+        else:
+            await update.message.reply_text("❌ خطا در تنظیم چنل.")
+        
+        user_data.clear()
     
     async def button_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle button callbacks"""
         query = update.callback_query
         await query.answer()
         
-        user_id = query.from_user.id
         data = query.data
+        key = self._SEND_PLAYLIST_PREFIX if data.startswith(self._SEND_PLAYLIST_PREFIX) else data
         
         # Check admin for restricted actions
-        if data in ['add_playlist', 'remove_playlist', 'check_now'] or data.startswith('send_playlist_'):
-            if not self.is_admin(user_id):
-                await query.edit_message_text("⛔️ فقط ادمین‌ها می‌توانند این عملیات را انجام دهند.")
-                return
-        
-        # Handle different callbacks
-        if data == "add_playlist":
-            await query.edit_message_text(
-                "لطفا لینک پلی‌لیست اسپاتیفای را ارسال کنید:\n"
-                "مثال: https://open.spotify.com/playlist/...\n\n"
-                "یا /cancel برای لغو"
-            )
-            context.user_data['awaiting_playlist_url'] = True
-        
-        elif data == "list_playlists":
-            await self.show_playlists_with_buttons(query)
-        
-        elif data == "remove_playlist":
-            await self.handle_remove_callback(query, context)
-        
-        elif data == "check_now":
-            await query.edit_message_text("🔄 در حال چک و ارسال تمام پلی‌لیست‌ها...")
-            await self.check_all_playlists()
-            await query.message.reply_text("✅ چک و ارسال تمام پلی‌لیست‌ها تکمیل شد.")
-        
-        elif data == "show_stats":
-            await self.show_stats_callback(query)
-        
-        elif data == "show_help":
-            await self.show_help_callback(query)
-        
-        elif data.startswith("send_playlist_"):
-            # Send specific playlist immediately
-            playlist_index = int(data.split("_")[-1])
-            await self.send_specific_playlist(query, playlist_index)
+        if key in self._ADMIN_CALLBACKS and not self.is_admin(query.from_user.id):
+            await query.edit_message_text("⛔️ فقط ادمین‌ها می‌توانند این عملیات را انجام دهند.")
+            return
         
-        elif data == "send_latest_playlist":
-            # Send the last added playlist
-            playlists = self.config_manager.get_playlists()
-            if playlists:
-                await query.edit_message_text("🔄 در حال چک و ارسال پلی‌لیست جدید...")
-                await self.check_playlist(playlists[-1]['url'])
-                await query.message.reply_text("✅ پلی‌لیست جدید چک و ارسال شد.")
+        handler = self._callback_handlers.get(key)
+        if handler:
+            await handler(query, context, data)
+    
+    async def _cb_add_playlist(self, query, context, data: str):
+        await query.edit_message_text(self._add_playlist_prompt)
+        context.user_data['state'] = ChatState.AWAIT_PLAYLIST_URL
+    
+    async def _cb_show_main_menu(self, query, context, data: str):
+        welcome_message, reply_markup = self._main_menu(query.from_user)
+        await query.edit_message_text(welcome_message, reply_markup=reply_markup)
+    
+    async def _cb_list_playlists(self, query, context, data: str):
+        await self.show_playlists_with_buttons(query)
+    
+    async def _cb_remove_playlist(self, query, context, data: str):
+        await self.handle_remove_callback(query, context)
+    
+    async def _cb_check_now(self, query, context, data: str):
+        chat_id = query.message.chat_id
+        await self._enqueue(chat_id, query.edit_message_text("🔄 در حال چک و ارسال تمام پلی‌لیست‌ها..."))
+        await self._request_check()
+        await self._enqueue(chat_id, query.message.reply_text("✅ چک و ارسال تمام پلی‌لیست‌ها تکمیل شد."))
+    
+    async def _cb_show_stats(self, query, context, data: str):
+        await self.show_stats_callback(query)
+    
+    async def _cb_show_help(self, query, context, data: str):
+        await self.show_help_callback(query)
+    
+    async def _cb_send_playlist(self, query, context, data: str):
+        # Send specific playlist immediately
+        playlist_index = int(data[len(self._SEND_PLAYLIST_PREFIX):])
+        await self.send_specific_playlist(query, playlist_index)
+    
+    async def _cb_send_latest_playlist(self, query, context, data: str):
+        # Send the last added playlist
+        playlists = self.config_manager.get_playlists()
+        if playlists:
+            chat_id = query.message.chat_id
+            await self._enqueue(chat_id, query.edit_message_text(
+                "🔄 در حال چک و ارسال پلی‌لیست جدید..."
+            ))
+            await self.check_playlist(playlists[-1]['url'])
+            await self._enqueue(chat_id, query.message.reply_text(
+                "✅ پلی‌لیست جدید چک و ارسال شد."
+            ))
     
     async def show_playlists_with_buttons(self, query):
         """Show playlists with inline buttons"""
@@ -673,33 +1262,24 @@ class SpotifyTelegramBot:
             await query.edit_message_text("📭 هیچ پلی‌لیستی ثبت نشده است.")
             return
         
-        message = "📋 پلی‌لیست‌های ثبت شده:\n\n"
+        parts = ["📋 پلی‌لیست‌های ثبت شده:\n\n"]
         keyboard = []
         
         for i, playlist in enumerate(playlists, 1):
-            last_check = playlist.get('last_check', 'هرگز')
-            if last_check != 'هرگز':
-                last_check = datetime.fromisoformat(last_check).strftime('%Y-%m-%d %H:%M')
-            
-            message += f"{i}. 🎵 {playlist['name']}\n"
-            message += f"   📊 تعداد آهنگ: {playlist.get('track_count', 0)}\n"
-            message += f"   🕐 آخرین چک: {last_check}\n\n"
+            parts.append(
+                f"{i}. 🎵 {playlist['name']}\n"
+                f"   📊 تعداد آهنگ: {playlist.get('track_count', 0)}\n"
+                f"   🕐 آخرین چک: {self._format_last_check(playlist)}\n\n"
+            )
             
             # Add send button for each playlist
-            keyboard.append([
-                InlineKeyboardButton(
-                    f"📤 ارسال: {playlist['name'][:20]}...",
-                    callback_data=f"send_playlist_{i-1}"
-                )
-            ])
+            keyboard.append(self._send_button_row("📤 ارسال", playlist['name'], i - 1))
         
         # Add check all button
-        keyboard.append([
-            InlineKeyboardButton("🔄 چک و ارسال همه", callback_data="check_now")
-        ])
+        keyboard.append(self._check_all_row)
         
         reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(message, reply_markup=reply_markup)
+        await query.edit_message_text(''.join(parts), reply_markup=reply_markup)
     
     async def handle_remove_callback(self, query, context):
         """Handle remove playlist callback"""
@@ -708,68 +1288,18 @@ class SpotifyTelegramBot:
             await query.edit_message_text("📭 هیچ پلی‌لیستی برای حذف وجود ندارد.")
             return
         
-        message = "برای حذف، شماره پلی‌لیست را ارسال کنید:\n\n"
-        for i, playlist in enumerate(playlists, 1):
-            message += f"{i}. {playlist['name']}\n"
-        message += "\nیا /cancel برای لغو"
+        message = self._numbered_prompt("برای حذف، شماره پلی‌لیست را ارسال کنید:\n\n", playlists)
         
         await query.edit_message_text(message)
-        context.user_data['awaiting_playlist_remove'] = True
+        context.user_data['state'] = ChatState.AWAIT_PLAYLIST_REMOVE
     
     async def show_stats_callback(self, query):
         """Show statistics via callback"""
-        playlists = self.config_manager.get_playlists()
-        total_tracks = sum(self.tracks_db.get(p['url'], {}).get('total_tracks', 0) 
-                          for p in playlists)
-        total_sent = sum(self.tracks_db.get(p['url'], {}).get('sent_tracks', 0) 
-                        for p in playlists)
-        
-        stats_message = f"""
-📊 آمار ربات:
-
-🎵 تعداد پلی‌لیست‌ها: {len(playlists)}
-🎼 کل آهنگ‌ها: {total_tracks}
-✅ آهنگ‌های ارسال شده: {total_sent}
-⏰ بازه چک: 6 ساعت
-🎚️ کیفیت: 128kbps
-"""
-        
-        keyboard = [[
-            InlineKeyboardButton("🔙 بازگشت", callback_data="list_playlists")
-        ]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(stats_message, reply_markup=reply_markup)
+        await query.edit_message_text(self._build_stats_message(), reply_markup=self._back_to_list_markup)
     
     async def show_help_callback(self, query):
         """Show help via callback"""
-        help_text = """
-📖 راهنمای استفاده:
-
-1️⃣ افزودن پلی‌لیست:
-/addplaylist یا دکمه "افزودن پلی‌لیست"
-
-2️⃣ تنظیم چنل:
-/setchannel یا دکمه "تنظیم چنل"
-
-3️⃣ مشاهده پلی‌لیست‌ها:
-/listplaylists یا دکمه "لیست پلی‌لیست‌ها"
-
-4️⃣ ارسال فوری:
-از دکمه "ارسال فوری" کنار هر پلی‌لیست
-
-5️⃣ چک همه:
-دکمه "چک و ارسال همه"
-
-⏰ ربات هر 6 ساعت به صورت خودکار چک می‌کند.
-"""
-        
-        keyboard = [[
-            InlineKeyboardButton("🔙 بازگشت به منو", callback_data="show_main_menu")
-        ]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(help_text, reply_markup=reply_markup)
+        await query.edit_message_text(self._callback_help_text, reply_markup=self._back_to_menu_markup)
     
     async def send_specific_playlist(self, query, playlist_index: int):
         """Send specific playlist immediately"""
@@ -777,88 +1307,150 @@ class SpotifyTelegramBot:
         
         if 0 <= playlist_index < len(playlists):
             playlist = playlists[playlist_index]
-            await query.edit_message_text(f"🔄 در حال چک و ارسال پلی‌لیست '{playlist['name']}'...")
+            chat_id = query.message.chat_id
+            await self._enqueue(chat_id, query.edit_message_text(
+                f"🔄 در حال چک و ارسال پلی‌لیست '{playlist['name']}'..."
+            ))
             
             await self.check_playlist(playlist['url'])
             
-            await query.message.reply_text(
+            await self._enqueue(chat_id, query.message.reply_text(
                 f"✅ پلی‌لیست '{playlist['name']}' چک شد و آهنگ‌های جدید ارسال شدند."
-            )
+            ))
         else:
             await query.edit_message_text("❌ پلی‌لیست یافت نشد.")
     
+    @staticmethod
+    @lru_cache(maxsize=512)
+    def _send_button_row(label: str, name: str, index: int) -> tuple:
+        """Keyboard row with the send button for the playlist at index"""
+        return (InlineKeyboardButton(
+            f"{label}: {name[:20]}...",
+            callback_data=f"send_playlist_{index}"
+        ),)
+    
+    @staticmethod
+    def _load_audio(file_path: str) -> InputFile:
+        """Read an audio file into an InputFile (blocking)"""
+        with open(file_path, 'rb') as f:
+            return InputFile(f, filename=os.path.basename(file_path))
+    
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def _caption(track_name: str, artist_name: str) -> str:
+        """Channel post caption for a track"""
+        return (
+            f"🎵 <b>{track_name}</b>\n"
+            f"🎤 {artist_name}\n\n"
+            f"#موسیقی #دانلود"
+        )
+    
     async def send_audio_to_channel(self, file_path: str, track_name: str, 
                                    artist_name: str, channel_id: str) -> bool:
         """Send audio file to specified channel"""
         try:
-            if not os.path.exists(file_path):
-                logger.error(f"File not found: {file_path}")
-                return False
-            
-            caption = (
-                f"🎵 <b>{track_name}</b>\n"
-                f"🎤 {artist_name}\n\n"
-                f"#موسیقی #دانلود"
-            )
+            caption = self._caption(track_name, artist_name)
             
-            bot = Bot(token=self.telegram_token)
-            with open(file_path, 'rb') as audio:
-                await bot.send_audio(
-                    chat_id=channel_id,
-                    audio=audio,
-                    caption=caption,
-                    parse_mode='HTML',
-                    title=track_name,
-                    performer=artist_name
-                )
+            # Read the file on a worker thread; InputFile buffers it in full anyway
+            audio = await asyncio.to_thread(self._load_audio, file_path)
+            channel_limit = self._channel_limits.get(channel_id)
+            if channel_limit is None:
+                channel_limit = self._channel_limits[channel_id] = RateLimiter(20, 60)
+            for attempt in range(1, self._MAX_SEND_ATTEMPTS + 1):
+                try:
+                    # Wait for the channel's budget before taking a global send slot
+                    async with channel_limit, self._send_sem, self._rate:
+                        await self.bot.send_audio(
+                            chat_id=channel_id,
+                            audio=audio,
+                            caption=caption,
+                            parse_mode='HTML',
+                            title=track_name,
+                            performer=artist_name
+                        )
+                    break
+                except RetryAfter as e:
+                    if attempt == self._MAX_SEND_ATTEMPTS:
+                        raise
+                    # Back off this send only, without holding a send slot
+                    delay = e.retry_after
+                    if isinstance(delay, timedelta):
+                        delay = delay.total_seconds()
+                    # retry_after is rounded down, one extra second avoids a second 429
+                    delay += 1
+                    logger.warning(f"⏳ Flood limit, retrying {track_name} in {delay}s")
+                    await asyncio.sleep(delay)
+                except TimedOut:
+                    if attempt == self._MAX_SEND_ATTEMPTS:
+                        raise
+                    delay = 2 ** attempt
+                    logger.warning(f"⏳ Upload timed out, retrying {track_name} in {delay}s")
+                    await asyncio.sleep(delay)
             
             logger.info(f"✅ Sent: {track_name} - {artist_name} to {channel_id}")
             return True
             
+        except FileNotFoundError:
+            logger.error(f"File not found: {file_path}")
+            return False
+        # Classified by exception type; no matching on the error text
+        except Forbidden as e:
+            logger.error(f"❌ Bot can't post to {channel_id} (is it a channel admin?): {e}")
+            return False
+        except BadRequest as e:
+            logger.error(f"❌ Telegram rejected {track_name} for {channel_id}: {e}")
+            return False
         except Exception as e:
             logger.error(f"Error sending file: {e}")
             return False
     
     async def check_playlist(self, playlist_url: str):
         """Check a single playlist for new tracks"""
+        lock = self._check_locks.setdefault(playlist_url, asyncio.Lock())
+        task = asyncio.current_task()
+        self._running_checks.add(task)
+        try:
+            async with lock:
+                await self._check_playlist(playlist_url)
+        finally:
+            self._running_checks.discard(task)
+    
+    async def _check_playlist(self, playlist_url: str):
+        """Fetch, diff and process one playlist; callers hold its lock"""
         try:
             logger.info(f"🔍 Checking playlist: {playlist_url}")
             
+            # Skip the full fetch when the playlist snapshot has not changed
+            snapshot_id, track_count = await self.spotify.get_playlist_snapshot_async(playlist_url)
+            playlist_data = self.tracks.get_playlist(playlist_url)
+            if playlist_data and snapshot_id and playlist_data['snapshot_id'] == snapshot_id:
+                self.config_manager.update_playlist_check(playlist_url, track_count)
+                logger.info("✅ Playlist unchanged")
+                return
+            
             # Get tracks from Spotify
-            tracks = await asyncio.to_thread(
-                self.spotify.get_playlist_tracks,
-                playlist_url
-            )
+            tracks = await self.spotify.get_playlist_tracks_async(playlist_url)
             
             if not tracks:
                 logger.warning(f"No tracks found for {playlist_url}")
                 return
             
-            # Initialize playlist in DB if not exists
-            if playlist_url not in self.tracks_db:
-                self.tracks_db[playlist_url] = {
-                    'tracks': {},
-                    'total_tracks': 0,
-                    'sent_tracks': 0
-                }
-            
-            playlist_data = self.tracks_db[playlist_url]
-            new_tracks = []
-            
-            # Find new tracks
-            for track in tracks:
-                track_id = track['id']
-                if track_id not in playlist_data['tracks']:
-                    new_tracks.append(track)
-                    playlist_data['tracks'][track_id] = {
-                        'name': track['name'],
-                        'artists': track['artists'],
-                        'added_at': datetime.now().isoformat(),
-                        'sent': False
-                    }
-            
-            playlist_data['total_tracks'] = len(tracks)
-            self._save_tracks_db()
+            known_tracks = self.tracks.track_ids(playlist_url)
+            now_iso = datetime.now().isoformat()
+            
+            # Find new tracks (dict keeps playlist order and drops repeated IDs).
+            # Local files have no ID, can't be recorded and would come back as new
+            # on every snapshot change, so they are skipped.
+            new_tracks = list({
+                track['id']: track for track in tracks
+                if track['id'] is not None and track['id'] not in known_tracks
+            }.values())
+            self.tracks.add_tracks(playlist_url, new_tracks, now_iso)
+            
+            previous_total = playlist_data['total_tracks'] if playlist_data else 0
+            self._bump_tracks(total_delta=len(tracks) - previous_total)
+            self.tracks.update_playlist(playlist_url, len(tracks), snapshot_id)
+            self._mark_tracks_dirty()
             
             # Update config
             self.config_manager.update_playlist_check(playlist_url, len(tracks))
@@ -872,91 +1464,151 @@ class SpotifyTelegramBot:
         except Exception as e:
             logger.error(f"Error checking playlist: {e}", exc_info=True)
     
+    def _gc_downloads_sync(self) -> int:
+        """Delete audio files left in the download directory, return how many"""
+        removed = 0
+        with os.scandir(self.download_dir) as entries:
+            for entry in entries:
+                # download_dir is user-editable, so only audio the downloader writes is removed
+                if not entry.is_file() or os.path.splitext(entry.name)[1] not in _AUDIO_EXTS:
+                    continue
+                # A download may have started after _gc_downloads was scheduled
+                if self._active_downloads:
+                    break
+                try:
+                    os.unlink(entry.path)
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    logger.warning(f"Failed to delete file {entry.path}: {e}")
+        return removed
+    
+    async def _gc_downloads(self):
+        """Sweep leftovers of aborted downloads in a worker thread"""
+        removed = await asyncio.to_thread(self._gc_downloads_sync)
+        if removed:
+            logger.info(f"🗑️ Removed {removed} leftover files from {self.download_dir}")
+    
+    async def _notify_admins(self, text: str):
+        """Message every admin through their chat queues; delivery failures are ignored"""
+        await asyncio.gather(
+            *(
+                self._enqueue(admin_id, self.bot.send_message(chat_id=admin_id, text=text))
+                for admin_id in self.admin_ids
+            ),
+            return_exceptions=True
+        )
+    
     async def process_new_tracks(self, playlist_url: str, tracks: List[dict]):
         """Download and send new tracks"""
         try:
             # Check if ARL is configured
             if not self.deezer_arl:
                 logger.error("❌ Deezer ARL not configured!")
-                # Notify admin
-                for admin_id in self.admin_ids:
-                    try:
-                        bot = Bot(token=self.telegram_token)
-                        await bot.send_message(
-                            chat_id=admin_id,
-                            text="❌ خطا: Deezer ARL تنظیم نشده است!\n\n"
-                                 "برای تنظیم از دستور /setuparl استفاده کنید."
-                        )
-                    except:
-                        pass
-                return
-            
-            tracks_to_download = [
-                (track['name'], ', '.join(track['artists']))
-                for track in tracks
-            ]
-            
-            logger.info(f"📥 Downloading {len(tracks_to_download)} tracks...")
-            
-            # Download tracks
-            downloaded = await asyncio.to_thread(
-                self.downloader.download_tracks,
-                tracks_to_download,
-                output_dir=self.download_dir,
-                bitrate=self.config_manager.config['settings']['bitrate']
-            )
-            
-            if not downloaded:
-                logger.warning("⚠️ No tracks were downloaded")
+                await self._notify_admins(
+                    "❌ خطا: Deezer ARL تنظیم نشده است!\n\n"
+                    "برای تنظیم از دستور /setuparl استفاده کنید."
+                )
                 return
             
-            logger.info(f"✅ Downloaded {len(downloaded)} tracks")
-            
-            # Send to channel
-            playlist_data = self.tracks_db[playlist_url]
-            success_count = 0
-            
             # Get channel ID for this playlist
             channel_id = self.config_manager.get_playlist_channel(playlist_url)
             if not channel_id:
                 logger.error(f"❌ No channel configured for playlist: {playlist_url}")
                 return
             
-            for track_name, artist_name, file_path in downloaded:
-                if await self.send_audio_to_channel(file_path, track_name, artist_name, channel_id):
-                    # Mark as sent
-                    for track in tracks:
-                        if track['name'] == track_name:
-                            playlist_data['tracks'][track['id']]['sent'] = True
-                            playlist_data['sent_tracks'] += 1
-                            success_count += 1
-                            break
-                    
-                    await asyncio.sleep(2)  # Rate limiting
+            bitrate = self.config_manager.config['settings']['bitrate']
+            success_count = 0
+            
+            # artists_str is joined once by SpotifyAPI when the track is first seen
+            tracks_to_download = [(track['name'], track['artists_str']) for track in tracks]
+            
+            logger.info(f"📥 Downloading {len(tracks_to_download)} tracks...")
+            
+            window = asyncio.Semaphore(self._UPLOAD_WINDOW)
+            
+            async def send_and_record(index: int, file_path: str):
+                nonlocal success_count
+                track_name, artist_name = tracks_to_download[index]
+                async with window:
+                    sent = await self.send_audio_to_channel(file_path, track_name, artist_name, channel_id)
+                
+                if sent:
+                    # The downloader reports the track's index, so the match is exact
+                    if self.tracks.mark_sent(playlist_url, tracks[index]['id']):
+                        self._bump_tracks(sent_delta=1)
+                    success_count += 1
                 
                 # Clean up downloaded file
                 try:
-                    if os.path.exists(file_path):
-                        os.remove(file_path)
-                        logger.info(f"🗑️ Cleaned up: {file_path}")
-                except Exception as e:
+                    await asyncio.to_thread(os.unlink, file_path)
+                    logger.info(f"🗑️ Cleaned up: {file_path}")
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
                     logger.warning(f"Failed to delete file {file_path}: {e}")
             
-            self._save_tracks_db()
+            # Pipeline: the downloader thread queues each finished file and it is
+            # uploaded while the remaining tracks are still downloading
+            loop = asyncio.get_running_loop()
+            queue: asyncio.Queue = asyncio.Queue()
+            
+            def on_complete(index: int, file_path: str):
+                loop.call_soon_threadsafe(queue.put_nowait, (index, file_path))
+            
+            async def upload_all():
+                uploads = []
+                while (item := await queue.get()) is not None:
+                    uploads.append(asyncio.create_task(send_and_record(*item)))
+                await asyncio.gather(*uploads)
+            
+            self._active_downloads += 1
+            consumer = asyncio.create_task(upload_all())
+            try:
+                downloaded = await loop.run_in_executor(self._download_pool, partial(
+                    self.downloader.download_tracks,
+                    tracks_to_download,
+                    output_dir=self.download_dir,
+                    bitrate=bitrate,
+                    on_complete=on_complete
+                ))
+            finally:
+                # Queued after every on_complete callback, so it is seen last
+                queue.put_nowait(None)
+                try:
+                    await consumer
+                finally:
+                    self._active_downloads -= 1
+            
+            # Other playlists share download_dir, so only sweep once none is downloading
+            if not self._active_downloads:
+                await self._gc_downloads()
+            
+            if not downloaded:
+                logger.warning("⚠️ No tracks were downloaded")
+                return
+            
+            self._mark_tracks_dirty()
             logger.info(f"✅ Successfully sent {success_count}/{len(downloaded)} tracks to {channel_id}")
             
         except Exception as e:
             logger.error(f"Error processing tracks: {e}", exc_info=True)
-            # Notify admin of error
-            for admin_id in self.admin_ids:
-                try:
-                    bot = Bot(token=self.telegram_token)
-                    await bot.send_message(
-                        chat_id=admin_id,
-                        text=f"❌ خطا در پردازش آهنگ‌ها:\n{str(e)}"
-                    )
-                except:
-                    pass
+            await self._notify_admins(f"❌ خطا در پردازش آهنگ‌ها:\n{str(e)}")
+    
+    def _check_concurrency(self) -> int:
+        """check_concurrency setting (or CHECK_CONCURRENCY), at least 1"""
+        value = self.config_manager.config['settings'].get('check_concurrency')
+        if value is None:
+            value = os.getenv('CHECK_CONCURRENCY', 4)
+        try:
+            concurrency = int(value)
+        except (TypeError, ValueError):
+            logger.warning(f"Invalid check concurrency {value!r}, using 4")
+            return 4
+        if concurrency < 1:
+            logger.warning(f"Check concurrency {concurrency} is below 1, using 1")
+        return max(1, concurrency)
     
     async def check_all_playlists(self):
         """Check all playlists for new tracks"""
@@ -968,49 +1620,96 @@ class SpotifyTelegramBot:
         
         logger.info(f"🔄 Checking {len(playlists)} playlists...")
         
-        for playlist in playlists:
-            await self.check_playlist(playlist['url'])
-            await asyncio.sleep(5)  # Delay between playlists
+        # Check playlists concurrently, bounded to respect Spotify/Deezer limits
+        sem = asyncio.Semaphore(self._check_concurrency())
+        
+        async def check_one(playlist: dict):
+            # Failures are logged here so one playlist can't cancel the group
+            try:
+                async with sem:
+                    await self.check_playlist(playlist['url'])
+            except Exception as e:
+                logger.error(f"Error checking {playlist['url']}: {e}", exc_info=True)
+        
+        async with asyncio.TaskGroup() as tg:
+            for playlist in playlists:
+                tg.create_task(check_one(playlist))
     
     async def periodic_check(self):
-        """Periodic playlist checking"""
+        """Periodic playlist checking; _request_check wakes it early"""
         while True:
+            waiters, self._check_waiters = self._check_waiters, []
+            self._check_trigger.clear()
             try:
                 await self.check_all_playlists()
-                
                 check_interval = self.config_manager.config['settings']['check_interval']
                 logger.info(f"⏰ Next check in {check_interval // 3600} hours")
-                await asyncio.sleep(check_interval)
-                
             except Exception as e:
                 logger.error(f"Error in periodic check: {e}", exc_info=True)
-                await asyncio.sleep(3600)  # Retry in 1 hour
+                check_interval = 3600  # Retry in 1 hour
+            finally:
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_result(None)
+            
+            try:
+                await asyncio.wait_for(self._check_trigger.wait(), timeout=check_interval)
+            except asyncio.TimeoutError:
+                pass
+    
+    async def _start_periodic_check(self, context: ContextTypes.DEFAULT_TYPE):
+        """Job callback: start periodic_check, keeping its task for shutdown"""
+        self._periodic_task = asyncio.create_task(self.periodic_check())
+    
+    async def _request_check(self):
+        """Run a check through periodic_check now and wait until it is done"""
+        waiter = asyncio.get_running_loop().create_future()
+        self._check_waiters.append(waiter)
+        self._check_trigger.set()
+        await waiter
     
     def run(self):
         """Run the bot"""
         # Create application
-        app = Application.builder().token(self.telegram_token).build()
+        app = (
+            Application.builder()
+            .bot(self.bot)
+            .post_init(self._post_init)
+            .post_shutdown(self._post_shutdown)
+            .concurrent_updates(True)
+            .build()
+        )
         
         # Add handlers
-        app.add_handler(CommandHandler("start", self.start_command))
-        app.add_handler(CommandHandler("help", self.help_command))
-        app.add_handler(CommandHandler("addplaylist", self.add_playlist_command))
-        app.add_handler(CommandHandler("setchannel", self.set_channel_command))
-        app.add_handler(CommandHandler("listplaylists", self.list_playlists_command))
-        app.add_handler(CommandHandler("removeplaylist", self.remove_playlist_command))
-        app.add_handler(CommandHandler("checkplaylists", self.check_playlists_command))
-        app.add_handler(CommandHandler("stats", self.stats_command))
-        app.add_handler(CommandHandler("setuparl", self.setup_arl_command))
-        app.add_handler(CommandHandler("setarl", self.set_arl_command))
-        app.add_handler(CallbackQueryHandler(self.button_callback))
-        app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_message))
+        app.add_handlers(
+            [CommandHandler(name, getattr(self, attr)) for name, attr in self._COMMANDS]
+            + [
+                CallbackQueryHandler(self.button_callback),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_message),
+            ]
+        )
         
         # Start periodic check
-        app.job_queue.run_once(lambda _: asyncio.create_task(self.periodic_check()), 10)
-        
-        # Run bot
-        logger.info("🚀 Bot is running...")
-        app.run_polling(allowed_updates=Update.ALL_TYPES)
+        app.job_queue.run_once(self._start_periodic_check, 10)
+        
+        # Run bot: webhook when WEBHOOK_URL is set, long polling otherwise
+        webhook_url = os.getenv('WEBHOOK_URL')
+        if webhook_url:
+            logger.info("🚀 Bot is running (webhook)...")
+            app.run_webhook(
+                listen='0.0.0.0',
+                port=int(os.getenv('PORT', '8443')),
+                url_path=self.telegram_token,
+                webhook_url=f"{webhook_url.rstrip('/')}/{self.telegram_token}",
+                allowed_updates=Update.ALL_TYPES
+            )
+        else:
+            logger.info("🚀 Bot is running (polling)...")
+            app.run_polling(
+                allowed_updates=Update.ALL_TYPES,
+                timeout=20,
+                poll_interval=0
+            )
 
 
 if __name__ == '__main__':